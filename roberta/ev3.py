@@ -1,21 +1,20 @@
 
-from PIL import Image, ImageFont
-import dbus    # only for waitForConnection() bluetooth
+from PIL import Image, ImageDraw, ImageFont
+import collections
 import glob    # only for stopAllMotors()
+import io
 import logging
 import math
 import os
+import select
+import struct
+import subprocess
 import threading  # only for ledOn() animations
 import time
+import wave
 
-# ignore failure to make this testable outside of the target platform
-try:
-    # this has not be release to debian
-    # https://bugs.debian.org/cgi-bin/bugreport.cgi?bug=787850
-    import bluetooth
-    from bluetooth import BluetoothSocket
-except ImportError:
-    pass
+# 'bluetooth' and 'dbus' are only imported by the communication functions
+# that use them, this keeps them out of the service startup
 
 try:
     from ev3dev import auto as ev3dev
@@ -29,6 +28,123 @@ def clamp(v, mi, ma):
     return mi if v < mi else ma if v > ma else v
 
 
+class SoundCache(object):
+    """Pre-rendered sounds, played through a single long-lived process.
+
+    Tones and speech are rendered to PCM (mono, 16 bit, 22050 Hz, which is
+    what espeak produces) once and kept in a LRU cache of max_size bytes.
+    Playing them writes the samples into the stdin of one aplay process.
+    """
+
+    RATE = 22050
+    AMPLITUDE = 16000
+    PLAYER = ['/usr/bin/aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', '1', '-r', str(RATE)]
+    SPEAKER = ['/usr/bin/espeak', '--stdout']
+
+    def __init__(self, max_size=1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.sounds = collections.OrderedDict()
+        self.player = None
+        self.busy_until = 0.0
+
+    def get(self, key, render, *args):
+        """Get the samples for key, calling render(*args) if they are not cached."""
+        pcm = self.sounds.get(key)
+        if pcm is None:
+            pcm = render(*args)
+            self.sounds[key] = pcm
+            self.size += len(pcm)
+            while self.size > self.max_size and len(self.sounds) > 1:
+                (_, old) = self.sounds.popitem(last=False)
+                self.size -= len(old)
+        else:
+            self.sounds.move_to_end(key)
+        return pcm
+
+    def play(self, pcm):
+        """Queue the samples and return the time when they will have been played."""
+        if self.player is None or self.player.poll() is not None:
+            self.player = subprocess.Popen(self.PLAYER, stdin=subprocess.PIPE)
+            self.busy_until = 0.0
+        # write in chunks, so that we stay interruptible if the pipe is full
+        view = memoryview(pcm)
+        for pos in range(0, len(pcm), 4096):
+            self.player.stdin.write(view[pos:pos + 4096])
+        self.player.stdin.flush()
+        self.busy_until = max(time.time(), self.busy_until) + len(pcm) / (2.0 * SoundCache.RATE)
+        return self.busy_until
+
+    def stop(self):
+        """Stop what is still playing and release the sound device."""
+        if self.player:
+            if time.time() < self.busy_until:
+                self.player.kill()
+            else:
+                try:
+                    # aplay exits once it has played all of its input
+                    self.player.stdin.close()
+                    self.player.wait(1.0)
+                except (OSError, subprocess.TimeoutExpired):
+                    self.player.kill()
+            self.player.wait()
+            self.player = None
+
+    @staticmethod
+    def renderTones(tones):
+        """Render a list of (frequency, duration ms, delay ms) square wave tones."""
+        rate = SoundCache.RATE
+        pcm = bytearray()
+        for (frequency, duration, delay) in tones:
+            n = int(rate * duration / 1000.0)
+            if frequency > 0:
+                period = max(2, int(round(rate / frequency)))
+                half = period // 2
+                cycle = (struct.pack('<h', SoundCache.AMPLITUDE) * half +
+                         struct.pack('<h', -SoundCache.AMPLITUDE) * (period - half))
+                pcm += (cycle * (n // period + 1))[:n * 2]
+            else:
+                pcm += bytes(n * 2)
+            pcm += bytes(int(rate * delay / 1000.0) * 2)
+        return bytes(pcm)
+
+    @staticmethod
+    def decodeWav(data):
+        """Get the samples from the wav data that espeak produced."""
+        with wave.open(io.BytesIO(data)) as wav:
+            if (wav.getnchannels(), wav.getsampwidth(), wav.getframerate()) != (1, 2, SoundCache.RATE):
+                raise ValueError('unsupported wav format: %s' % str(wav.getparams()))
+            return wav.readframes(wav.getnframes())
+
+
+class TextCache(object):
+    """Pre-rendered text for a bitmap font.
+
+    Rendered lines of text are kept as 1-bit masks in a LRU of max_strings
+    entries, so that repeated labels and numbers can be blitted directly.
+    The glyphs themselves are already stored as a packed 1-bit atlas in the
+    PIL bitmap fonts.
+    """
+
+    def __init__(self, font, max_strings=128):
+        self.font = font
+        self.max_strings = max_strings
+        self.strings = collections.OrderedDict()
+
+    def getMask(self, text):
+        """Get a 1-bit mask for a single line of text."""
+        mask = self.strings.get(text)
+        if mask is None:
+            mask = Image.new('1', self.font.getsize(text), 0)
+            ImageDraw.Draw(mask).text((0, 0), text, font=self.font, fill=255)
+            self.strings[text] = mask
+            if len(self.strings) > self.max_strings:
+                self.strings.popitem(last=False)
+        else:
+            self.strings.move_to_end(text)
+        return mask
+
+
 class Hal(object):
     # class global, so that the front-end can cleanup on forced termination
     # popen objects
@@ -36,6 +152,10 @@ class Hal(object):
     # led blinker
     led_blink_thread = None
     led_blink_running = False
+    # pre-rendered sounds, set USE_SOUND_CACHE to False to play them through
+    # the ev3dev sound api instead
+    sound_cache = None
+    USE_SOUND_CACHE = True
 
     GYRO_MODES = {
         'angle': 'GYRO-ANG',
@@ -51,25 +171,105 @@ class Hal(object):
 
     LED_ALL = ev3dev.Leds.LEFT + ev3dev.Leds.RIGHT
 
+    # keep sysfs attribute files open and read them with pread(), see
+    # readAttribute(); set to False to use the ev3dev attribute access
+    CACHE_ATTRIBUTES = True
+
+    # max. milliseconds to block in waitForMotors(), this keeps the wait
+    # interruptible (e.g. by the soft-abort) if no notification arrives
+    MOTOR_WAIT_TIMEOUT = 100
+
+    # max. seconds to block in waitCmd(), this keeps the wait interruptible
+    CMD_WAIT_TIMEOUT = 0.1
+
+    # struct formats for the sensor 'bin_data_format'
+    BIN_DATA_FORMATS = {
+        'u8': '<B',
+        's8': '<b',
+        'u16': '<H',
+        's16': '<h',
+        's16_be': '>h',
+        's32': '<i',
+        'float': '<f',
+    }
+
+    KEY_ALIASES = {
+        'escape':  'backspace',
+        'back': 'backspace',
+    }
+    # seconds for which a read of the buttons is reused, see getPressedKeys()
+    KEYS_MAX_AGE = 0.01
+    # bundled fonts by size, see getFont()
+    FONTS = {
+        12: 'ter-u12n_unicode.pil',  # char size: 6 x 12 -> num-chars: 29.666667 x 10.666667
+        14: 'ter-u14n_unicode.pil',
+        18: 'ter-u18n_unicode.pil',  # char size: 10 x 18 -> num-chars: 17.800000 x 7.111111
+    }
+    # class global, fonts are only loaded when used and shared by all instances
+    fonts = {}
+    text_caches = {}
+
     def __init__(self, brickConfiguration):
         self.cfg = brickConfiguration
-        dir = os.path.dirname(__file__)
-        # char size: 6 x 12 -> num-chars: 29.666667 x 10.666667
-        self.font_s = ImageFont.load(os.path.join(dir, 'ter-u12n_unicode.pil'))
-        # char size: 10 x 18 -> num-chars: 17.800000 x 7.111111
-        # self.font_s = ImageFont.load(os.path.join(dir, 'ter-u18n_unicode.pil'))
-        self.lcd = ev3dev.Screen()
+        # the screen is opened on first use, see lcd
+        self._lcd = None
+        # size of a char in font_s, see drawText()
+        self.char_size = None
         self.led = ev3dev.Leds
         self.keys = ev3dev.Button()
+        self.keys_max_age = Hal.KEYS_MAX_AGE
+        self.keys_pressed = frozenset()
+        self.keys_read_at = None
         self.sound = ev3dev.Sound
-        (self.font_w, self.font_h) = self.lcd.draw.textsize('X', font=self.font_s)
-        # logger.info('char size: %d x %d -> num-chars: %f x %f',
-        #     self.font_w, self.font_h, 178 / self.font_w, 128 / self.font_h)
         self.timers = {}
+        # last mode we've set per sensor port, see getSensor()
+        self.sensor_modes = {}
+        # (struct, scale) per (sensor port, mode), see scaledValues()
+        self.bin_data_decoders = {}
+        # open sysfs attribute files per (device path, attribute name)
+        self.cache_attributes = Hal.CACHE_ATTRIBUTES
+        self.attribute_files = {}
         self.sys_bus = None
         self.bt_server = None
         self.bt_connections = []
         self.lang = 'de'
+        # display rows (first, last + 1) that need to be copied to the
+        # framebuffer and the nesting depth of beginFrame() calls
+        self.dirty_rows = None
+        self.frame_depth = 0
+
+    @property
+    def lcd(self):
+        if self._lcd is None:
+            self._lcd = ev3dev.Screen()
+        return self._lcd
+
+    @property
+    def font_s(self):
+        return Hal.getFont(12)
+
+    @property
+    def font_w(self):
+        return self._getCharSize()[0]
+
+    @property
+    def font_h(self):
+        return self._getCharSize()[1]
+
+    def _getCharSize(self):
+        if self.char_size is None:
+            # char size: 6 x 12 -> num-chars: 29.666667 x 10.666667
+            self.char_size = self.font_s.getsize('X')
+        return self.char_size
+
+    @staticmethod
+    def getFont(size=12):
+        """Get one of the bundled fonts, see FONTS."""
+        font = Hal.fonts.get(size)
+        if font is None:
+            font = ImageFont.load(os.path.join(os.path.dirname(__file__), Hal.FONTS[size]))
+            Hal.fonts[size] = font
+        return font
 
     # factory methods
     @staticmethod
@@ -222,8 +422,10 @@ class Hal(object):
 
     # state
     def resetState(self):
+        self.resetSensorModes()
         self.clearDisplay()
         self.stopAllMotors()
+        self.closeAttributes()
         self.resetAllOutputs()
         self.resetLED()
         logger.debug("terminate %d commands", len(Hal.cmds))
@@ -233,6 +435,108 @@ class Hal(object):
                 cmd.terminate()
                 cmd.wait()  # avoid zombie processes
         Hal.cmds = []
+        self.releaseSound()
+
+    # sysfs attributes
+    def readAttribute(self, device, name):
+        """Read a sysfs attribute of an ev3dev device.
+
+        The attribute file is kept open and read with a single pread() call.
+        Returns the raw bytes or None if the attribute can't be read this way.
+        """
+        path = getattr(device, '_path', None)
+        if not path:
+            return None
+        try:
+            if not self.cache_attributes:
+                with open(os.path.join(path, name), 'rb', buffering=0) as f:
+                    return f.read()
+            return os.pread(self._getAttributeFile(path, name).fileno(), 4096, 0)
+        except OSError:
+            self._dropAttributeFile(path, name)
+            return None
+
+    def readAttributeInto(self, device, name, buf):
+        """Read a sysfs attribute of an ev3dev device into a bytearray.
+
+        Like readAttribute(), but reuses buf instead of allocating new bytes.
+        Returns the number of bytes read or None.
+        """
+        path = getattr(device, '_path', None)
+        if not path:
+            return None
+        try:
+            if not self.cache_attributes:
+                with open(os.path.join(path, name), 'rb', buffering=0) as f:
+                    return f.readinto(buf)
+            f = self._getAttributeFile(path, name)
+            if hasattr(os, 'preadv'):  # python >= 3.7
+                return os.preadv(f.fileno(), [buf], 0)
+            f.seek(0)
+            return f.readinto(buf)
+        except OSError:
+            self._dropAttributeFile(path, name)
+            return None
+
+    def _dropAttributeFile(self, path, name):
+        # e.g. the device has been unplugged
+        f = self.attribute_files.pop((path, name), None)
+        if f:
+            f.close()
+
+    def _getAttributeFile(self, path, name):
+        key = (path, name)
+        f = self.attribute_files.get(key)
+        if f is None:
+            f = open(os.path.join(path, name), 'rb', buffering=0)
+            self.attribute_files[key] = f
+        return f
+
+    def writeAttribute(self, path, value):
+        """Write to a sysfs attribute file with a single write() call.
+
+        The file is not kept open: replugged devices get a new path, so a
+        cached handle would leak.
+        """
+        with open(path, 'wb', buffering=0) as f:
+            f.write(value.encode('ascii'))
+
+    def closeAttributes(self):
+        """Close the attribute files kept open by readAttribute()."""
+        for f in self.attribute_files.values():
+            f.close()
+        self.attribute_files = {}
+
+    def getMotorState(self, m):
+        data = self.readAttribute(m, 'state') if self.cache_attributes else None
+        return m.state if data is None else data.decode('ascii').split()
+
+    def getMotorPosition(self, m):
+        data = self.readAttribute(m, 'position') if self.cache_attributes else None
+        return m.position if data is None else int(data)
+
+    def waitForMotors(self, motors, busy):
+        """Wait while busy() returns True for the list of motor states.
+
+        Sleeps until the kernel notifies a change of one of the 'state'
+        attributes (POLLPRI), but wakes up at least every MOTOR_WAIT_TIMEOUT
+        ms. Falls back to busyWait() if the attributes can't be polled.
+        """
+        poller = None
+        if self.cache_attributes and all(getattr(m, '_path', None) for m in motors):
+            poller = select.poll()
+            try:
+                for m in motors:
+                    poller.register(self._getAttributeFile(m._path, 'state'), select.POLLPRI)
+            except OSError:
+                poller = None
+        # reading the state re-arms the notification, so we always read
+        # before polling
+        while busy([self.getMotorState(m) for m in motors]):
+            if poller:
+                poller.poll(Hal.MOTOR_WAIT_TIMEOUT)
+            else:
+                self.busyWait()
 
     # control
     def waitFor(self, ms):
@@ -242,19 +546,114 @@ class Hal(object):
         """Used as interruptable busy wait."""
         time.sleep(0.0)
 
+    def waitUntil(self, t):
+        """Interruptable wait until the given time."""
+        while True:
+            delay = t - time.time()
+            if delay <= 0:
+                break
+            time.sleep(min(delay, Hal.CMD_WAIT_TIMEOUT))
+
     def waitCmd(self, cmd):
         """Wait for a command to finish."""
         Hal.cmds.append(cmd)
-        # we're not using cmd.wait() since that is not interruptable
-        while cmd.poll() is None:
-            self.busyWait()
+        # we're not using cmd.wait() without a timeout since that is not
+        # interruptable
+        while True:
+            try:
+                cmd.wait(Hal.CMD_WAIT_TIMEOUT)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+        Hal.cmds.remove(cmd)
+
+    def readCmd(self, cmd):
+        """Wait for a command to finish and return its output."""
+        Hal.cmds.append(cmd)
+        # like waitCmd(), communicate() can be resumed after a timeout
+        while True:
+            try:
+                (output, _) = cmd.communicate(timeout=Hal.CMD_WAIT_TIMEOUT)
+                break
+            except subprocess.TimeoutExpired:
+                pass
         Hal.cmds.remove(cmd)
+        if cmd.returncode:
+            raise subprocess.CalledProcessError(cmd.returncode, cmd.args, output)
+        return output
 
     # lcd
+    def beginFrame(self):
+        """Start a batch of draw calls.
+
+        The display is only updated once, when the matching commitFrame() is
+        called.
+        """
+        self.frame_depth += 1
+
+    def commitFrame(self):
+        """Finish a batch of draw calls and update the changed display rows."""
+        self.frame_depth = max(0, self.frame_depth - 1)
+        if not self.frame_depth:
+            self.updateDisplay()
+
+    def invalidateRows(self, first, last):
+        """Mark the display rows [first, last) as changed."""
+        first = max(0, first)
+        last = min(self.lcd.image.height, last)
+        if first >= last:
+            return
+        if self.dirty_rows:
+            first = min(first, self.dirty_rows[0])
+            last = max(last, self.dirty_rows[1])
+        self.dirty_rows = (first, last)
+        if not self.frame_depth:
+            self.updateDisplay()
+
+    def updateDisplay(self):
+        """Copy the changed rows to the framebuffer."""
+        if not self.dirty_rows:
+            return
+        (first, last) = self.dirty_rows
+        self.dirty_rows = None
+        lcd = self.lcd
+        try:
+            bpp = lcd.var_info.bits_per_pixel
+            line_length = lcd.fix_info.line_length
+            fb = lcd.mmap
+        except AttributeError:
+            bpp = None
+        # these are the formats that ev3dev's Screen.update() uses
+        if bpp == 1:
+            rows = lcd.image.crop((0, first, lcd.image.width, last)).tobytes('raw', '1;R')
+        elif bpp == 32:
+            rows = lcd.image.crop((0, first, lcd.image.width, last)).convert('RGB').tobytes('raw', 'XRGB')
+        else:
+            lcd.update()
+            return
+        fb[first * line_length:first * line_length + len(rows)] = rows
+
     def drawText(self, msg, x, y, font=None):
-        font = font or self.font_s
-        self.lcd.draw.text((x * self.font_w, y * self.font_h), msg, font=font)
-        self.lcd.update()
+        # font: a font object or the size of one of the bundled fonts
+        if font is None:
+            font = self.font_s
+        elif isinstance(font, int):
+            font = Hal.getFont(font)
+        (x, y) = (x * self.font_w, y * self.font_h)
+        if not msg:
+            return
+        if '\n' in msg:
+            self.lcd.draw.text((x, y), msg, font=font)
+            h = self.lcd.draw.textsize(msg, font=font)[1]
+        else:
+            text_cache = Hal.text_caches.get(font)
+            if text_cache is None:
+                text_cache = TextCache(font)
+                Hal.text_caches[font] = text_cache
+            mask = text_cache.getMask(msg)
+            self.lcd.draw.bitmap((x, y), mask)
+            h = mask.height
+        self.invalidateRows(y, y + h)
 
     def drawPicture(self, picture, x, y):
         # logger.info('len(picture) = %d', len(picture))
@@ -264,11 +663,11 @@ class Hal(object):
         data = bytes(picture, 'utf-16')[::2]
         pixels = Image.frombytes('1', size, data, 'raw', '1;IR', 0, 1)
         self.lcd.image.paste(pixels, (x, y))
-        self.lcd.update()
+        self.invalidateRows(y, y + size[1])
 
     def clearDisplay(self):
         self.lcd.clear()
-        self.lcd.update()
+        self.invalidateRows(0, self.lcd.image.height)
 
     # led
 
@@ -313,27 +712,78 @@ class Hal(object):
         self.ledOff()
 
     # key
+    def getPressedKeys(self):
+        """Get a snapshot of the pressed keys.
+
+        The buttons are read at most once per keys_max_age seconds, so that
+        checking several keys in a loop only reads them once per iteration.
+        """
+        now = time.time()
+        if self.keys_read_at is None or now - self.keys_read_at >= self.keys_max_age:
+            self.keys_pressed = frozenset(self.keys.buttons_pressed)
+            self.keys_read_at = now
+        return self.keys_pressed
+
     def isKeyPressed(self, key):
+        pressed = self.getPressedKeys()
         if key in ['any', '*']:
-            return self.keys.any()
+            return len(pressed) > 0
         else:
             # remap some keys
-            key_aliases = {
-                'escape':  'backspace',
-                'back': 'backspace',
-            }
-            if key in key_aliases:
-                key = key_aliases[key]
-            return key in self.keys.buttons_pressed
+            return Hal.KEY_ALIASES.get(key, key) in pressed
 
     def isKeyPressedAndReleased(self, key):
         return False
 
     # tones
+    def releaseSound(self):
+        """Stop the sound cache player, so that other processes can use the sound device."""
+        if Hal.sound_cache:
+            Hal.sound_cache.stop()
+
+    def playCached(self, key, render, *args):
+        """Play a sound from the sound cache and wait until it is done.
+
+        The sound is rendered by render(*args), if it is not cached yet.
+        Returns False if the sound cache can't be used.
+        """
+        if not Hal.USE_SOUND_CACHE:
+            return False
+        if not Hal.sound_cache:
+            Hal.sound_cache = SoundCache()
+        try:
+            pcm = Hal.sound_cache.get(key, render, *args)
+        except (OSError, ValueError, EOFError, wave.Error, subprocess.CalledProcessError):
+            # e.g. an unsupported voice, only skip the cache for this sound
+            logger.exception('can\'t render %s', key[0])
+            # the fallback needs the sound device
+            self.releaseSound()
+            return False
+        try:
+            end = Hal.sound_cache.play(pcm)
+        except OSError:
+            logger.exception('sound cache not available')
+            Hal.USE_SOUND_CACHE = False
+            self.releaseSound()
+            return False
+        self.waitUntil(end)
+        return True
+
+    def renderSpeech(self, text, espeak_opts):
+        cmd = subprocess.Popen(SoundCache.SPEAKER + espeak_opts.split() + [text], stdout=subprocess.PIPE)
+        return SoundCache.decodeWav(self.readCmd(cmd))
+
+    def playTones(self, tones):
+        # tones: list of (frequency, duration ms, delay ms)
+        tones = tuple(tones)
+        if not self.playCached(('tones', tones), SoundCache.renderTones, tones):
+            self.waitCmd(self.sound.tone(list(tones)))
+
     def playTone(self, frequency, duration):
         # this is already handled by the sound api (via beep cmd)
         # frequency = frequency if frequency >= 100 else 0
-        self.waitCmd(self.sound.tone(frequency, duration))
+        if not self.playCached(('tones', frequency, duration), SoundCache.renderTones, [(frequency, duration, 0)]):
+            self.waitCmd(self.sound.tone(frequency, duration))
 
     def playFile(self, systemSound):
         # systemSound is a enum for preset beeps:
@@ -343,11 +793,11 @@ class Hal(object):
         if systemSound == 0:
             self.playTone(600, 200)
         elif systemSound == 1:
-            self.sound.tone([(600, 150, 50), (600, 150, 50)]).wait()
+            self.playTones([(600, 150, 50), (600, 150, 50)])
         elif systemSound == 2:  # C major arpeggio
-            self.sound.tone([(C2 * i / 4, 50, 50) for i in range(4, 7)]).wait()
+            self.playTones([(C2 * i / 4, 50, 50) for i in range(4, 7)])
         elif systemSound == 3:
-            self.sound.tone([(C2 * i / 4, 50, 50) for i in range(7, 4, -1)]).wait()
+            self.playTones([(C2 * i / 4, 50, 50) for i in range(7, 4, -1)])
         elif systemSound == 4:
             self.playTone(100, 500)
 
@@ -369,7 +819,8 @@ class Hal(object):
             int(clamp(pitch, 0, 100) * 0.99),  # use range 0 - 99
             int(clamp(speed, 0, 100) * 2.5 + 100),  # use range 100 - 350
             self.lang + "+f1")  # female voice
-        self.waitCmd(self.sound.speak(text, espeak_opts=opts))
+        if not self.playCached(('speech', text, opts), self.renderSpeech, text, opts):
+            self.waitCmd(self.sound.speak(text, espeak_opts=opts))
 
     # actors
     # http://www.ev3dev.org/docs/drivers/tacho-motor-class/
@@ -382,13 +833,11 @@ class Hal(object):
         speed = self.scaleSpeed(m, clamp(speed_pct, -100, 100))
         if mode == 'degree':
             m.run_to_rel_pos(position_sp=value, speed_sp=speed)
-            while m.state and 'stalled' not in m.state:
-                self.busyWait()
+            self.waitForMotors([m], lambda states: states[0] and 'stalled' not in states[0])
         elif mode == 'rotations':
             value *= m.count_per_rot
             m.run_to_rel_pos(position_sp=int(value), speed_sp=speed)
-            while m.state and 'stalled' not in m.state:
-                self.busyWait()
+            self.waitForMotors([m], lambda states: states[0] and 'stalled' not in states[0])
 
     def rotateUnregulatedMotor(self, port, speed_pct, mode, value):
         speed_pct = clamp(speed_pct, -100, 100)
@@ -396,14 +845,14 @@ class Hal(object):
         if mode == 'rotations':
             value *= m.count_per_rot
         if speed_pct >= 0:
-            value = m.position + value
+            value = self.getMotorPosition(m) + value
             m.run_direct(duty_cycle_sp=int(speed_pct))
-            while m.position < value and 'stalled' not in m.state:
+            while self.getMotorPosition(m) < value and 'stalled' not in self.getMotorState(m):
                 self.busyWait()
         else:
-            value = m.position - value
+            value = self.getMotorPosition(m) - value
             m.run_direct(duty_cycle_sp=int(speed_pct))
-            while m.position > value and 'stalled' not in m.state:
+            while self.getMotorPosition(m) > value and 'stalled' not in self.getMotorState(m):
                 self.busyWait()
         m.stop()
 
@@ -449,11 +898,9 @@ class Hal(object):
     def stopAllMotors(self):
         # [m for m in [Motor(port) for port in ['outA', 'outB', 'outC', 'outD']] if m.connected]
         for file in glob.glob('/sys/class/tacho-motor/motor*/command'):
-            with open(file, 'w') as f:
-                f.write('stop')
+            self.writeAttribute(file, 'stop')
         for file in glob.glob('/sys/class/dc-motor/motor*/command'):
-            with open(file, 'w') as f:
-                f.write('stop')
+            self.writeAttribute(file, 'stop')
 
     def resetAllOutputs(self):
         for port in (ev3dev.OUTPUT_A, ev3dev.OUTPUT_B, ev3dev.OUTPUT_C, ev3dev.OUTPUT_D):
@@ -492,8 +939,7 @@ class Hal(object):
         ml.run_to_rel_pos()
         mr.run_to_rel_pos()
         # logger.debug("driving: %s, %s" % (ml.state, mr.state))
-        while ml.state or mr.state:
-            self.busyWait()
+        self.waitForMotors([ml, mr], any)
 
     def rotateDirectionRegulated(self, left_port, right_port, reverse, direction, speed_pct):
         # direction: left, right
@@ -534,8 +980,7 @@ class Hal(object):
         ml.run_to_rel_pos()
         mr.run_to_rel_pos()
         logger.debug("turning: %s, %s" % (ml.state, mr.state))
-        while ml.state or mr.state:
-            self.busyWait()
+        self.waitForMotors([ml, mr], any)
 
     def driveInCurve(self, direction, left_port, left_speed_pct, right_port, right_speed_pct, distance=None):
         # direction: foreward, backward
@@ -565,8 +1010,9 @@ class Hal(object):
             # start motors
             ml.run_to_rel_pos()
             mr.run_to_rel_pos()
-            while (ml.state and left_speed_pct) or (mr.state and right_speed_pct):
-                self.busyWait()
+            # don't wait for a motor that does not move
+            motors = [m for (m, speed) in ((ml, left_speed_pct), (mr, right_speed_pct)) if speed]
+            self.waitForMotors(motors, any)
         else:
             if direction == 'backward':
                 ml.run_forever(speed_sp=int(-left_speed_pct))
@@ -576,10 +1022,57 @@ class Hal(object):
                 mr.run_forever(speed_sp=int(right_speed_pct))
 
     # sensors
+    def getSensor(self, port, mode):
+        """Get the sensor on the given port and make sure it is in the given mode.
+
+        The mode is only read back from the sensor if we have not set it
+        ourselves before, see resetSensorModes().
+        """
+        s = self.cfg['sensors'][port]
+        if self.sensor_modes.get(port) != mode:
+            if s.mode != mode:
+                s.mode = mode
+            self.sensor_modes[port] = mode
+        return s
+
+    def resetSensorModes(self, port=None):
+        """Forget the sensor modes, e.g. after they have been changed directly."""
+        if port is None:
+            self.sensor_modes = {}
+            self.bin_data_decoders = {}
+        else:
+            self.sensor_modes.pop(port, None)
+            for key in [key for key in self.bin_data_decoders if key[0] == port]:
+                del self.bin_data_decoders[key]
+
     def scaledValue(self, sensor):
         return sensor.value() / float(10.0 ** sensor.decimals)
 
-    def scaledValues(self, sensor):
+    def _getBinDataDecoder(self, sensor, port):
+        key = (port, self.sensor_modes.get(port))
+        if key not in self.bin_data_decoders:
+            decoder = None
+            if key[1] and getattr(sensor, '_path', None):
+                fmt = Hal.BIN_DATA_FORMATS.get(sensor.bin_data_format)
+                if fmt:
+                    fmt = struct.Struct(fmt[0] + fmt[1] * sensor.num_values)
+                    decoder = (fmt, float(10.0 ** sensor.decimals), bytearray(fmt.size))
+            self.bin_data_decoders[key] = decoder
+        return self.bin_data_decoders[key]
+
+    def scaledValues(self, sensor, port=None):
+        """Read all values of the sensor.
+
+        If the port is given and the sensor mode is known (see getSensor()),
+        all values are read from 'bin_data' at once, instead of reading each
+        'value<n>' attribute.
+        """
+        decoder = self._getBinDataDecoder(sensor, port) if port is not None else None
+        if decoder:
+            (fmt, scale, buf) = decoder
+            size = self.readAttributeInto(sensor, 'bin_data', buf)
+            if size == fmt.size:
+                return tuple([v / scale for v in fmt.unpack_from(buf)])
         scale = float(10.0 ** sensor.decimals)
         return tuple([sensor.value(i) / scale for i in range(sensor.num_values)])
 
@@ -589,15 +1082,11 @@ class Hal(object):
 
     # ultrasonic sensor
     def getUltraSonicSensorDistance(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'US-DIST-CM':
-            s.mode = 'US-DIST-CM'
+        s = self.getSensor(port, 'US-DIST-CM')
         return self.scaledValue(s)
 
     def getUltraSonicSensorPresence(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'US-LISTEN':
-            s.mode = 'US-LISTEN'
+        s = self.getSensor(port, 'US-LISTEN')
         return self.scaledValue(s) != 0.0
 
     # gyro
@@ -607,52 +1096,39 @@ class Hal(object):
         s = self.cfg['sensors'][port]
         s.mode = 'GYRO-RATE'
         s.mode = 'GYRO-ANG'
+        self.sensor_modes[port] = 'GYRO-ANG'
 
     def getGyroSensorValue(self, port, mode):
-        s = self.cfg['sensors'][port]
-        if s.mode != Hal.GYRO_MODES[mode]:
-            s.mode = Hal.GYRO_MODES[mode]
+        s = self.getSensor(port, Hal.GYRO_MODES[mode])
         return self.scaledValue(s)
 
     # color
     # http://www.ev3dev.org/docs/sensors/lego-ev3-color-sensor/
     def getColorSensorAmbient(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COL-AMBIENT':
-            s.mode = 'COL-AMBIENT'
+        s = self.getSensor(port, 'COL-AMBIENT')
         return self.scaledValue(s)
 
     def getColorSensorColour(self, port):
         colors = ['none', 'black', 'blue', 'green', 'yellow', 'red', 'white', 'brown']
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COL-COLOR':
-            s.mode = 'COL-COLOR'
+        s = self.getSensor(port, 'COL-COLOR')
         return colors[int(self.scaledValue(s))]
 
     def getColorSensorRed(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COL-REFLECT':
-            s.mode = 'COL-REFLECT'
+        s = self.getSensor(port, 'COL-REFLECT')
         return self.scaledValue(s)
 
     def getColorSensorRgb(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'RGB-RAW':
-            s.mode = 'RGB-RAW'
-        return self.scaledValues(s)
+        s = self.getSensor(port, 'RGB-RAW')
+        return self.scaledValues(s, port)
 
     # infrared
     # http://www.ev3dev.org/docs/sensors/lego-ev3-infrared-sensor/
     def getInfraredSensorSeek(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'IR-SEEK':
-            s.mode = 'IR-SEEK'
-        return self.scaledValues(s)
+        s = self.getSensor(port, 'IR-SEEK')
+        return self.scaledValues(s, port)
 
     def getInfraredSensorDistance(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'IR-PROX':
-            s.mode = 'IR-PROX'
+        s = self.getSensor(port, 'IR-PROX')
         return self.scaledValue(s)
 
     # timer
@@ -690,15 +1166,11 @@ class Hal(object):
     def getSoundLevel(self, port):
         # 100 for silent,
         # 0 for loud
-        s = self.cfg['sensors'][port]
-        if s.mode != 'DB':
-            s.mode = 'DB'
+        s = self.getSensor(port, 'DB')
         return round(-self.scaledValue(s) + 100, 2)  # map to 0 silent 100 loud
 
     def getHiTecCompassSensorValue(self, port, mode):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COMPASS':
-            s.mode = 'COMPASS'  # ev3dev currently only supports the compass mode
+        s = self.getSensor(port, 'COMPASS')  # ev3dev currently only supports the compass mode
         value = self.scaledValue(s)
         if mode == 'angle':
             return -(((value + 180) % 360) - 180)  # simulate the angle [-180, 180] mode from ev3lejos
@@ -706,17 +1178,13 @@ class Hal(object):
             return value
 
     def getHiTecIRSeekerSensorValue(self, port, mode):
-        s = self.cfg['sensors'][port]
-        if s.mode != mode:
-            s.mode = mode
+        s = self.getSensor(port, mode)
         value = self.scaledValue(s)
         # remap from [1 - 9] default 0 to [120, -120] default NaN like ev3lejos
         return float('nan') if value == 0 else (value - 5) * -30
 
     def getHiTecColorSensorV2Colour(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'COLOR':
-            s.mode = 'COLOR'
+        s = self.getSensor(port, 'COLOR')
         value = s.value()
         return self.mapHiTecColorIdToColor(int(value))
 
@@ -746,24 +1214,18 @@ class Hal(object):
         return colors[id]
 
     def getHiTecColorSensorV2Ambient(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'PASSIVE':
-            s.mode = 'PASSIVE'
+        s = self.getSensor(port, 'PASSIVE')
         value = abs(s.value(0)) / 380
         return min(value, 100)
 
     def getHiTecColorSensorV2Light(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'NORM':
-            s.mode = 'NORM'
-        value = self.scaledValues(s)[3] / 2.55
+        s = self.getSensor(port, 'NORM')
+        value = self.scaledValues(s, port)[3] / 2.55
         return value
 
     def getHiTecColorSensorV2Rgb(self, port):
-        s = self.cfg['sensors'][port]
-        if s.mode != 'NORM':
-            s.mode = 'NORM'
-        value = self.scaledValues(s)
+        s = self.getSensor(port, 'NORM')
+        value = self.scaledValues(s, port)
         value = list(value)
         del value[0]
         return value
@@ -779,6 +1241,9 @@ class Hal(object):
         return str(e) == "timed out"
 
     def establishConnectionTo(self, host):
+        # this has not be release to debian
+        # https://bugs.debian.org/cgi-bin/bugreport.cgi?bug=787850
+        import bluetooth
         # host can also be a name, resolving it is slow though and requires the
         # device to be visible
         if not bluetooth.is_valid_address(host):
@@ -788,7 +1253,7 @@ class Hal(object):
                     host = bdaddr
                     break
         if bluetooth.is_valid_address(host):
-            con = BluetoothSocket(bluetooth.RFCOMM)
+            con = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
             con.settimeout(0.5)  # half second to make IO interruptible
             while True:
                 try:
@@ -803,6 +1268,8 @@ class Hal(object):
             return -1
 
     def waitForConnection(self):
+        import bluetooth
+        import dbus
         # enable visibility
         if not self.sys_bus:
             self.sys_bus = dbus.SystemBus()
@@ -815,7 +1282,7 @@ class Hal(object):
         props.Set('org.bluez.Adapter1', 'Discoverable', True)
 
         if not self.bt_server:
-            self.bt_server = BluetoothSocket(bluetooth.RFCOMM)
+            self.bt_server = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
             self.bt_server.settimeout(0.5)  # half second to make IO interruptible
             self.bt_server.bind(("", bluetooth.PORT_ANY))
             self.bt_server.listen(1)
@@ -833,6 +1300,7 @@ class Hal(object):
         return -1
 
     def readMessage(self, con_ix):
+        import bluetooth
         message = "NO MESSAGE"
         if con_ix < len(self.bt_connections) and self.bt_connections[con_ix]:
             con = self.bt_connections[con_ix]
@@ -854,6 +1322,7 @@ class Hal(object):
         return message
 
     def sendMessage(self, con_ix, message):
+        import bluetooth
         if con_ix < len(self.bt_connections) and self.bt_connections[con_ix]:
             logger.debug('sending msg [%s]' % message)
             con = self.bt_connections[con_ix]
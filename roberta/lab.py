@@ -3,28 +3,39 @@ import ctypes
 import dbus
 import dbus.service
 from fcntl import ioctl
+import functools
+import hashlib
+import http.client
+import inspect
+import io
 import json
 import logging
+import marshal
 import os
+import resource
+import select
+import signal
 import socket
 import stat
 import struct
 import time
 import _thread
 import threading
-import urllib.request
 import urllib.error
 import urllib.parse
+import urllib.request
 import sys
 
 local_pkg_path = os.path.expanduser('~/.local/lib/python')
 # ignore failure to make this testable outside of the target platform
 try:
     from ev3dev import auto as ev3dev
-    from .ev3 import Hal
 except ImportError:
     from .test import Ev3dev as ev3dev
     from .test import Hal
+else:
+    # the hal pulls in PIL, it is imported on first use, see Service.hal
+    Hal = None
 
 logger = logging.getLogger('roberta.lab')
 
@@ -35,6 +46,20 @@ logger = logging.getLogger('roberta.lab')
 #        (needs robertalab > 1.4 or develop branch)
 TOKEN_PER_SESSION = True
 
+# TRUE: run the programs in a process forked from a pre-started interpreter
+#       that has already imported the hal, see startZygote()
+# FALSE: run the programs in the service process
+EXEC_IN_SUBPROCESS = False
+
+# TRUE: only send the params that identify the brick on 'register' and a
+#       minimal set on 'push' (needs a server that keeps them per token)
+# FALSE: send all params with every request
+COMPACT_PUSH = False
+
+# environment variable that hands the session over to the restarted service
+# after an update, see Connector.getSession()
+SESSION_ENV = 'ROBERTA_SESSION'
+
 
 # helpers
 def getHwAddr(ifname):
@@ -44,6 +69,35 @@ def getHwAddr(ifname):
     return ':'.join(['%02x' % char for char in info[18:24]])
 
 
+def getMacAddress(net_path='/sys/class/net'):
+    """Get the MAC address of the wlan, usb or eth interface.
+
+    The first interface of each type is used, a later type takes precedence
+    (eth0 over usb0 over wlan0). Returns None if there is no such interface.
+    If net_path can't be listed, the interfaces are probed with getHwAddr().
+    """
+    try:
+        ifnames = set(os.listdir(net_path))
+    except OSError:
+        logger.warning('can\'t list %s, probing interfaces', net_path)
+        ifnames = None
+    macaddr = None
+    for iface in ['wlan', 'usb', 'eth']:
+        for ix in range(10):
+            ifname = iface + str(ix)
+            try:
+                if ifnames is None:
+                    macaddr = getHwAddr(bytes(ifname, 'ascii'))
+                    break
+                if ifname in ifnames:
+                    with open(os.path.join(net_path, ifname, 'address'), 'r') as address:
+                        macaddr = address.read().strip()
+                    break
+            except OSError:
+                pass
+    return macaddr
+
+
 def generateToken():
     # note: we intentionally leave '01' and 'IO' out since they can be confused
     # when entering the code
@@ -53,8 +107,381 @@ def generateToken():
     return ''.join(chars[b[i] % len(chars)] for i in range(8))
 
 
-def getBatteryVoltage():
-    return "{0:.3f}".format(ev3dev.PowerSupply().measured_volts)
+def installUpdate(fileobj, pkg_path, digest=None):
+    """Install the 'roberta' package from a zip that is read from fileobj.
+
+    The zip is spooled to disk, checked against digest (the value of a
+    'Digest: sha-256=...' header, if given) and extracted next to the
+    package. Only then the old package is moved to 'roberta.old' and the new
+    one is put in place. Raises ValueError if the update is broken, the
+    installed package is left alone then.
+    """
+    # import them here, since we don't use them otherwise
+    import base64
+    import shutil
+    import zipfile
+
+    pkg_dir = os.path.join(pkg_path, 'roberta')
+    old_dir = os.path.join(pkg_path, 'roberta.old')
+    staging_dir = os.path.join(pkg_path, 'roberta.new')
+    zip_filename = os.path.join(pkg_path, 'roberta.zip')
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    try:
+        sha256 = hashlib.sha256()
+        with open(zip_filename, 'wb') as zip_file:
+            for chunk in iter(lambda: fileobj.read(64 * 1024), b''):
+                sha256.update(chunk)
+                zip_file.write(chunk)
+        if digest:
+            (algorithm, value) = digest.split('=', 1)
+            if algorithm.lower() != 'sha-256':
+                logger.warning('ignoring unsupported digest: %s', algorithm)
+            elif base64.b64decode(value) != sha256.digest():
+                raise ValueError('digest mismatch')
+        # this checks the crc of each file, a corrupt zip raises BadZipFile
+        with zipfile.ZipFile(zip_filename, 'r') as zip_ref:
+            zip_ref.extractall(staging_dir)
+        if not os.path.isdir(os.path.join(staging_dir, 'roberta')):
+            raise ValueError('no roberta package in update')
+    except zipfile.BadZipFile as e:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise ValueError(e)
+    except:  # noqa: E722
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    finally:
+        if os.path.exists(zip_filename):
+            os.remove(zip_filename)
+
+    # swap the packages, keep the current one for a rollback
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(pkg_dir):
+        os.rename(pkg_dir, old_dir)
+    try:
+        os.rename(os.path.join(staging_dir, 'roberta'), pkg_dir)
+    except OSError:
+        if os.path.exists(old_dir):
+            os.rename(old_dir, pkg_dir)
+        raise
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def startZygote():
+    """Start the interpreter that the program processes are forked from.
+
+    This is the 'forkserver' of multiprocessing, it has roberta.ev3 (and with it
+    ev3dev and PIL) imported already. Returns the multiprocessing context to
+    create the processes.
+    """
+    # import them here, since we don't use them otherwise
+    import multiprocessing
+    from multiprocessing import forkserver
+
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload(['roberta.ev3', 'roberta.lab'])
+    forkserver.ensure_running()
+    return ctx
+
+
+def runProgram(code, conn, profile=False):
+    """Run a marshalled program and send (result, profile report) to conn.
+
+    This is run in a process that has been forked from the zygote.
+    """
+    # get killed when the zygote exits, which it does when the service exits
+    # PR_SET_PDEATHSIG = 1
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.prctl(1, signal.SIGKILL, 0, 0, 0)
+    scope = {
+        '__name__': '__main__',
+        'result': 0,
+    }
+    profiler = HalProfiler() if profile else None
+    try:
+        if profiler:
+            profiler.start()
+        exec(marshal.loads(code), scope)
+    finally:
+        if profiler:
+            profiler.stop()
+        conn.send((scope['result'], profiler.report() if profiler else None))
+
+
+class HalProfiler(object):
+    """Count and time the calls of the Hal methods while a program runs.
+
+    All public methods of roberta.ev3.Hal are wrapped between start() and
+    stop(). report() returns the wall and cpu time, the peak rss and the
+    number of calls and the cumulative time per method.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.originals = {}
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def _wrap(self, name, func):
+        stats = self.calls.setdefault(name, [0, 0.0])
+        perf_counter = time.perf_counter
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += perf_counter() - start
+        return wrapper
+
+    def start(self):
+        from .ev3 import Hal as hal_class
+        self.hal_class = hal_class
+        for name, attr in list(vars(hal_class).items()):
+            if name.startswith('_'):
+                continue
+            if isinstance(attr, staticmethod):
+                wrapped = staticmethod(self._wrap(name, attr.__func__))
+            elif inspect.isfunction(attr):
+                wrapped = self._wrap(name, attr)
+            else:
+                continue
+            self.originals[name] = attr
+            setattr(hal_class, name, wrapped)
+        self.wall_time = time.time()
+        self.cpu_time = time.process_time()
+
+    def stop(self):
+        self.wall_time = time.time() - self.wall_time
+        self.cpu_time = time.process_time() - self.cpu_time
+        for name, attr in self.originals.items():
+            setattr(self.hal_class, name, attr)
+        self.originals = {}
+
+    def report(self):
+        calls = sorted(((name, stats[0], round(stats[1] * 1000, 3))
+                        for (name, stats) in self.calls.items() if stats[0]),
+                       key=lambda call: call[2], reverse=True)
+        return {
+            'wall_ms': round(self.wall_time * 1000, 1),
+            'cpu_ms': round(self.cpu_time * 1000, 1),
+            'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            # [method, number of calls, cumulative ms]
+            'calls': calls,
+        }
+
+
+class Backoff(object):
+    """Jittered exponential backoff with a policy per class of errors.
+
+    policies maps the error class to (initial delay, max. delay) in seconds.
+    The delay doubles with each consecutive failure of the same class and a
+    random delay between half and the full value is used, so that many bricks
+    don't retry in lock step.
+    """
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.error = ''  # class of the last error, '' if the last try worked
+        self.failures = 0  # number of consecutive failures of that class
+        self.delay = 0.0
+        self.retry_at = 0.0
+
+    def failed(self, error):
+        """Record a failure, returns the seconds to wait before retrying."""
+        if error != self.error:
+            self.error = error
+            self.failures = 0
+        self.failures += 1
+        (initial, maximum) = self.policies[error]
+        delay = min(maximum, initial * 2 ** (self.failures - 1))
+        # note: we don't use the random module since it is large
+        jitter = int.from_bytes(os.urandom(2), 'little') / 0xFFFF
+        self.delay = delay * (0.5 + jitter * 0.5)
+        self.retry_at = time.time() + self.delay
+        return self.delay
+
+    def succeeded(self):
+        self.error = ''
+        self.failures = 0
+        self.delay = 0.0
+        self.retry_at = 0.0
+
+    def getState(self):
+        return {
+            'error': self.error,
+            'failures': self.failures,
+            'delay': self.delay,
+            'remaining': max(0.0, self.retry_at - time.time()),
+        }
+
+
+class HttpSession(object):
+    """Keep-alive HTTP(S) client
+
+    Keeps one persistent connection per scheme and host, so that subsequent
+    requests don't pay for a new TCP (and TLS) handshake. A connection that
+    was closed by the server is transparently reopened once. Like
+    urllib.request.urlopen() it uses the proxies from the environment
+    (http_proxy, https_proxy, no_proxy) and follows redirects. Errors are
+    reported the same way, so that callers can handle urllib.error.HTTPError
+    and urllib.error.URLError as before.
+    """
+
+    MAX_REDIRECTIONS = 10  # same as urllib.request.HTTPRedirectHandler
+
+    def __init__(self, context=None, proxies=None):
+        self.context = context
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self.connections = {}
+        self.handshakes = 0  # number of connections that have been opened
+        self.cancelled = False  # see cancel()
+
+    def _proxy(self, scheme, host):
+        """Get the proxy host and its headers for a request, or None."""
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urllib.parse.urlsplit(proxy)
+        headers = {}
+        if parts.username is not None:
+            import base64
+            credentials = '%s:%s' % (urllib.parse.unquote(parts.username),
+                                     urllib.parse.unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf8')).decode('ascii')
+        return parts.netloc.rpartition('@')[2], headers
+
+    def _connection(self, scheme, host, timeout, proxy=None):
+        key = (scheme, host)
+        conn = self.connections.get(key)
+        if conn is None:
+            if scheme == 'https':
+                if proxy:
+                    conn = http.client.HTTPSConnection(proxy[0], timeout=timeout, context=self.context)
+                    conn.set_tunnel(host, headers=proxy[1])
+                else:
+                    conn = http.client.HTTPSConnection(host, timeout=timeout, context=self.context)
+            elif scheme == 'http':
+                conn = http.client.HTTPConnection(proxy[0] if proxy else host, timeout=timeout)
+            else:
+                raise urllib.error.URLError('unknown url type: %s' % scheme)
+            self.connections[key] = conn
+        else:
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+        return conn
+
+    def _drop(self, conn):
+        for key, value in list(self.connections.items()):
+            if value is conn:
+                del self.connections[key]
+        conn.close()
+
+    def request(self, url, data=None, headers=None, timeout=None):
+        """Send a request, POST if data is given, GET otherwise.
+
+        Returns a http.client.HTTPResponse, that needs to be read completely
+        before the next request is made.
+        """
+        headers = dict(headers or {})
+        for redirections in range(self.MAX_REDIRECTIONS + 1):
+            response = self._send(url, data, headers, timeout)
+            location = response.getheader('Location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                break
+            # read the body, so that the connection can be reused
+            response.read()
+            location = urllib.parse.urljoin(url, location)
+            logger.debug('redirected from %s to %s', url, location)
+            if urllib.parse.urlsplit(location).scheme not in ('http', 'https'):
+                raise urllib.error.HTTPError(url, response.status, 'redirection to %s not allowed' % location,
+                                             response.msg, io.BytesIO())
+            if data is not None and response.status in (301, 302, 303):
+                # turn POST into GET, like browsers and urlopen() do
+                data = None
+                headers = {k: v for k, v in headers.items()
+                           if k.lower() not in ('content-type', 'content-length')}
+            url = location
+        else:
+            raise urllib.error.HTTPError(url, response.status, 'too many redirections', response.msg, io.BytesIO())
+        if response.status >= 300:
+            # read the body, so that the connection can be reused
+            body = response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(body))
+        return response
+
+    def _send(self, url, data, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        proxy = self._proxy(parts.scheme, parts.netloc)
+        if proxy and parts.scheme == 'http':
+            # plain http proxies get the absolute url
+            path = urllib.parse.urlunsplit(parts[:4] + ('',))
+            headers = dict(headers, **proxy[1])
+        else:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+        method = 'GET' if data is None else 'POST'
+        while True:
+            if self.cancelled:
+                raise urllib.error.URLError('request cancelled')
+            conn = self._connection(parts.scheme, parts.netloc, timeout, proxy)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, data, headers)
+            except (OSError, http.client.HTTPException) as e:
+                self._drop(conn)
+                if reused:
+                    logger.debug('stale connection to %s, reconnecting', parts.netloc)
+                    continue
+                raise urllib.error.URLError(e)
+            finally:
+                if not reused and conn.sock:
+                    self.handshakes += 1
+            if self.cancelled:
+                # cancel() might have missed the socket while connecting
+                self._drop(conn)
+                raise urllib.error.URLError('request cancelled')
+            try:
+                response = conn.getresponse()
+            except (ConnectionResetError, BrokenPipeError, http.client.BadStatusLine):
+                # the server closed the connection while it was idle
+                self._drop(conn)
+                if self.cancelled:
+                    raise urllib.error.URLError('request cancelled')
+                if reused:
+                    logger.debug('stale connection to %s, reconnecting', parts.netloc)
+                    continue
+                raise
+            except:  # noqa: E722
+                self._drop(conn)
+                raise
+            return response
+
+    def cancel(self):
+        """Abort pending requests from another thread and refuse new ones.
+
+        Requests that are waiting for a response fail with a URLError right
+        away, instead of when their timeout expires.
+        """
+        self.cancelled = True
+        for conn in list(self.connections.values()):
+            sock = conn.sock
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
 
 
 class Service(dbus.service.Object):
@@ -76,6 +503,7 @@ class Service(dbus.service.Object):
     """
 
     def __init__(self, path):
+        start = time.time()
         logger.info('version: %s', version)
         logger.info('python path: %s', (':'.join(sys.path)))
         # passing None for path is only for testing
@@ -83,47 +511,86 @@ class Service(dbus.service.Object):
             # needs /etc/dbus-1/system.d/openroberta.conf
             bus_name = dbus.service.BusName('org.openroberta.lab', bus=dbus.SystemBus())
             dbus.service.Object.__init__(self, bus_name, path)
-            logger.debug('object registered')
+            logger.debug('object registered after %.1f ms', (time.time() - start) * 1000)
+            # interfaces come and go with the network (e.g. usb, wifi dongles)
+            bus_name.get_bus().add_signal_receiver(self.updateMacAddress, signal_name='ServicesChanged',
+                                                   dbus_interface='net.connman.Manager')
             self.status('disconnected')
-        self.hal = Hal(None)
-        self.hal.clearDisplay()
+        # the hal is only created when needed, see hal
+        self._hal = None
         self.thread = None
+        self.profiling = False
         self.params = {
             'macaddr': '00:00:00:00:00:00',
             'firmwarename': 'ev3dev',
             'menuversion': version.split('-')[0],
         }
         self.updateConfiguration()
+        self.resumeSession()
+        logger.debug('service initialized in %.1f ms', (time.time() - start) * 1000)
+
+    @property
+    def hal(self):
+        if self._hal is None:
+            start = time.time()
+            hal_class = Hal
+            if hal_class is None:
+                from .ev3 import Hal as hal_class
+            self._hal = hal_class(None)
+            self._hal.clearDisplay()
+            logger.debug('hal initialized in %.1f ms', (time.time() - start) * 1000)
+        return self._hal
 
     def updateConfiguration(self):
         # or /etc/os-release
         with open('/proc/version', 'r') as ver:
             self.params['firmwareversion'] = ver.read()
 
-        for iface in ['wlan', 'usb', 'eth']:
-            for ix in range(10):
-                try:
-                    ifname = bytes(iface + str(ix), 'ascii')
-                    self.params['macaddr'] = getHwAddr(ifname)
-                    break
-                except IOError:
-                    pass
+        self.updateMacAddress()
         # reusing token is nice for developers, but the server started to reject
         # them
         if not TOKEN_PER_SESSION:
             self.params['token'] = generateToken()
 
+    def updateMacAddress(self, *args):
+        # called on network changes, see __init__()
+        macaddr = getMacAddress()
+        if macaddr and macaddr != self.params['macaddr']:
+            logger.debug('mac address: %s', macaddr)
+            self.params['macaddr'] = macaddr
+
+    def resumeSession(self):
+        """Continue the session of the service that restarted us after an update."""
+        session = os.environ.pop(SESSION_ENV, None)
+        if not session:
+            return
+        try:
+            session = json.loads(session)
+            thread = Connector(session['address'], self)
+            thread.setSession(session)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning('can\'t resume session: %s', e)
+            return
+        logger.info('resuming session with %s', thread.address)
+        self._connect(thread)
+        if thread.registered:
+            self.status('registered')
+
     @dbus.service.method('org.openroberta.lab', in_signature='s', out_signature='s')
     def connect(self, address):
         logger.debug('connect(%s)', address)
+        return self._connect(Connector(address, self))
+
+    def _connect(self, thread):
         if self.thread:
             logger.debug('disconnect() old thread')
             # make sure we don't change to disconnected when the thread
-            # eventually terminates after the http timeout
+            # terminates
             self.thread.service = None
-            self.thread.running = False
+            self.thread.stop()
         # start thread, connecting to address
-        self.thread = Connector(address, self)
+        self.thread = thread
+        self.thread.profiling = self.profiling
         self.thread.daemon = True
         self.thread.start()
         # TODO: we have to 'wait' until the connection has been established and
@@ -133,16 +600,33 @@ class Service(dbus.service.Object):
         self.status('connected')
         return self.thread.params['token']
 
+    @dbus.service.method('org.openroberta.lab', out_signature='a{sv}')
+    def getBackoff(self):
+        """Get the state of the retries after connection errors.
+
+        'error' is the class of the last error ('' if the last request
+        worked), 'failures' the number of consecutive failures, 'delay' and
+        'remaining' the seconds the connector waits resp. still waits.
+        """
+        if not self.thread:
+            return Backoff({}).getState()
+        return self.thread.backoff.getState()
+
+    @dbus.service.method('org.openroberta.lab', in_signature='b')
+    def setProfiling(self, enabled):
+        """Write a profile report next to each program that is run."""
+        logger.debug('setProfiling(%s)', enabled)
+        self.profiling = bool(enabled)
+        if self.thread:
+            self.thread.profiling = self.profiling
+
     @dbus.service.method('org.openroberta.lab')
     def disconnect(self):
         logger.debug('disconnect()')
-        self.thread.running = False
+        # this cancels a pending request, the thread ends right away unless it
+        # is running a program, we don't join() to not block the main loop
+        self.thread.stop()
         self.status('disconnected')
-        # end thread, can take up to 15 seconds (the timeout to return)
-        # hence we don't join(), when connecting again we create a new thread
-        # anyway
-        # self.thread.join()
-        # self.status('disconnected')
         self.thread = None
 
     @dbus.service.signal('org.openroberta.lab', signature='s')
@@ -172,15 +656,123 @@ class GfxMode(object):
 class AbortHandler(threading.Thread):
     """ Key press handler to abort running programms.
         Tests for a center+down press to soft-kill the programm or a 1 sec back
-        key press and terminate the whole process"""
+        key press and terminate the whole process.
+
+        The handler blocks on the key input device and only wakes up on key
+        events. If the device is not available, it polls the keys instead."""
 
-    def __init__(self, service, runner):
+    # input devices of the EV3 buttons (stretch, jessie)
+    KEY_DEVICES = [
+        '/dev/input/by-path/platform-gpio_keys-event',
+        '/dev/input/by-path/platform-gpio-keys.0-event',
+    ]
+    # struct input_event {struct timeval time; __u16 type; __u16 code; __s32 value;}
+    INPUT_EVENT = struct.Struct('llHHi')
+    EV_KEY = 0x01
+    KEY_BACKSPACE = 14
+    KEY_ENTER = 28
+    KEY_DOWN = 108
+    # EVIOCGKEY(96), 96 bytes are enough for KEY_MAX=0x2ff
+    EVIOCGKEY = (2 << 30) | (96 << 16) | (ord('E') << 8) | 0x18
+    # seconds the back key needs to be held for a hard abort
+    LONG_PRESS = 1.0
+
+    def __init__(self, service, runner, device=None):
         threading.Thread.__init__(self)
         self.service = service
         self.running = True
         self.runner = runner
+        self.device = device
+        # used to wake up the thread when the program has finished
+        self.lock = threading.Lock()
+        self.wakeup_r = self.wakeup_w = None
 
     def run(self):
+        with self.lock:
+            (self.wakeup_r, self.wakeup_w) = os.pipe()
+        fd = self._open_device()
+        try:
+            if fd is None:
+                logger.debug('no key input device, polling keys')
+                self._poll_keys()
+            else:
+                self._watch_keys(fd)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            with self.lock:
+                os.close(self.wakeup_r)
+                os.close(self.wakeup_w)
+                self.wakeup_w = None
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            if self.wakeup_w is not None:
+                os.write(self.wakeup_w, b'\0')
+
+    def _open_device(self):
+        for device in [self.device] if self.device else AbortHandler.KEY_DEVICES:
+            try:
+                return os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                pass
+        return None
+
+    def _pressed_keys(self, fd):
+        # start with the keys that are already pressed
+        buf = bytearray(96)
+        try:
+            ioctl(fd, AbortHandler.EVIOCGKEY, buf)
+        except OSError:
+            return set()
+        return set(code for code in range(len(buf) * 8) if buf[code >> 3] & (1 << (code & 7)))
+
+    def _watch_keys(self, fd):
+        pressed = self._pressed_keys(fd)
+        back_deadline = None
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        poller.register(self.wakeup_r, select.POLLIN)
+        while self.running:
+            if AbortHandler.KEY_BACKSPACE in pressed:
+                if back_deadline is None:
+                    back_deadline = time.time() + self.LONG_PRESS
+                logger.debug('back pressed')
+            else:
+                back_deadline = None
+                if AbortHandler.KEY_ENTER in pressed and AbortHandler.KEY_DOWN in pressed:
+                    self._soft_abort()
+                    break
+
+            timeout = None
+            if back_deadline is not None:
+                timeout = max(0, int((back_deadline - time.time()) * 1000))
+            events = poller.poll(timeout)
+            if not self.running:
+                break
+            if not events:
+                # if pressed for one sec, hard exit
+                self._hard_abort()
+                break
+            for (efd, mask) in events:
+                if efd != fd:
+                    continue
+                if not mask & select.POLLIN:
+                    logger.warning('key input device is gone, polling keys')
+                    self._poll_keys()
+                    return
+                data = os.read(fd, AbortHandler.INPUT_EVENT.size * 16)
+                for (_, _, ev_type, code, value) in AbortHandler.INPUT_EVENT.iter_unpack(
+                        data[:len(data) - len(data) % AbortHandler.INPUT_EVENT.size]):
+                    if ev_type != AbortHandler.EV_KEY:
+                        continue
+                    if value == 1:
+                        pressed.add(code)
+                    elif value == 0:
+                        pressed.discard(code)
+
+    def _poll_keys(self):
         long_press = 0
         hal = self.service.hal
         while self.running:
@@ -188,27 +780,33 @@ class AbortHandler(threading.Thread):
                 logger.debug('back: %d', long_press)
                 # if pressed for one sec, hard exit
                 if long_press > 10:
-                    logger.info('--- hard abort ---')
-                    _thread.interrupt_main()  # throws KeyboardInterrupt
-                    self.running = False
-                    # something is eating the KeyboardInterrupt, this is a bit
-                    # brute force, but works
-                    os._exit(1)
+                    self._hard_abort()
                 else:
                     long_press += 1
             elif hal.isKeyPressed('enter') and hal.isKeyPressed('down'):
-                logger.debug('--- soft-abort ---')
-                self.running = False
-                self.ctype_async_raise(SystemExit)
+                self._soft_abort()
             else:
                 long_press = 0
             time.sleep(0.1)
 
+    def _soft_abort(self):
+        logger.debug('--- soft-abort ---')
+        self.running = False
+        self.ctype_async_raise(SystemExit)
+
+    def _hard_abort(self):
+        logger.info('--- hard abort ---')
+        _thread.interrupt_main()  # throws KeyboardInterrupt
+        self.running = False
+        # something is eating the KeyboardInterrupt, this is a bit
+        # brute force, but works
+        os._exit(1)
+
     def __enter__(self):
         self.start()
 
     def __exit__(self, type, value, traceback):
-        self.running = False
+        self.stop()
         if type is not None:  # an exception has occurred
             logger.debug('Reraising exception: %s', str(type))
             return False      # reraise the exception
@@ -244,11 +842,51 @@ class AbortHandler(threading.Thread):
 class Connector(threading.Thread):
     """OpenRobertab-Lab network IO thread"""
 
+    # number of consecutive connection failures after which we stop using the
+    # cached protocol and server path and probe the server again
+    MAX_ROUTE_FAILURES = 3
+
+    # number of compiled programs to keep in the code cache, see _compile_code()
+    CODE_CACHE_SIZE = 32
+
+    # header of the code cache entries: compile time in seconds
+    CODE_CACHE_HEADER = struct.Struct('<d')
+
+    # max. seconds to block while waiting for a program process, this keeps
+    # the wait interruptible by the soft-abort
+    EXEC_WAIT_TIMEOUT = 0.1
+
+    # seconds the server may hold the 'register' and 'push' requests
+    REGISTER_TIMEOUT = 330
+    PUSH_TIMEOUT = 15
+
+    # seconds to wait between 'push' requests
+    PUSH_INTERVAL = 0.0
+
+    # params that are sent with 'push' requests in the COMPACT_PUSH mode
+    PUSH_PARAMS = ('cmd', 'token', 'battery', 'nepoexitvalue')
+
+    # seconds between updates of the brick name and battery, see _update_status()
+    STATUS_INTERVAL = 10.0
+    # weight of a new battery sample, this smoothes out voltage drops while
+    # the motors run
+    BATTERY_SMOOTHING = 0.3
+
+    # (initial, max.) seconds to wait before retrying after errors, see Backoff
+    BACKOFF_POLICIES = {
+        'server': (2.0, 120.0),  # HTTP 5xx
+        'network': (1.0, 60.0),  # connection failures and timeouts
+        'collision': (1.0, 10.0),  # token collision on 'register'
+        'other': (5.0, 300.0),  # unexpected errors, e.g. a bad reply
+        'update': (10.0, 600.0),  # broken update downloads
+    }
+
     def __init__(self, address, service):
         threading.Thread.__init__(self)
         self.address = address.split('://', 1)[-1]  # stip protocol part
         self.service = service
         self.home = os.path.expanduser("~")
+        self.code_cache = os.path.join(self.home, '.cache', 'roberta')
         if service:
             self.params = service.params
         else:
@@ -257,24 +895,168 @@ class Connector(threading.Thread):
             self.params['token'] = generateToken()
 
         self.registered = False
-        self.running = True   # Used to cancel this through self.thread.running
+        self.running = True   # Used to cancel this through stop()
+        self.wakeup = threading.Event()  # interrupts _wait() on stop()
+        self.backoff = Backoff(Connector.BACKOFF_POLICIES)
+        self.push_interval = Connector.PUSH_INTERVAL
+        # see _update_status()
+        self.status_at = None
+        self.power_supply = None
+        self.battery = None
+        self.session = HttpSession()
+        # protocol and path prefix the server answers on, see _request()
+        self.protocol = 'https'
+        self.prefix = ''
+        self.route_failures = 0
+        self.fallback_probes = 0
+        # write a profile report for each program, see _exec_code()
+        self.profiling = False
+        # (etag, filename) of the last downloaded program, see _download()
+        self.last_download = None
         logger.debug('thread created')
 
-    def _store_code(self, filename, code):
+    def _update_status(self):
+        now = time.time()
+        if self.status_at is not None and now - self.status_at < Connector.STATUS_INTERVAL:
+            return
+        self.status_at = now
+        self.params['brickname'] = socket.gethostname()
+        if self.power_supply is None:
+            self.power_supply = ev3dev.PowerSupply()
+        volts = self.power_supply.measured_volts
+        if self.battery is None:
+            self.battery = volts
+        else:
+            self.battery += Connector.BATTERY_SMOOTHING * (volts - self.battery)
+        self.params['battery'] = "{0:.3f}".format(self.battery)
+
+    def stop(self):
+        """Stop the thread, a pending request is cancelled."""
+        self.running = False
+        self.wakeup.set()
+        self.session.cancel()
+
+    def _wait(self, seconds):
+        # sleep, unless we get stopped
+        if seconds > 0:
+            self.wakeup.wait(seconds)
+
+    def _retry_later(self, error):
+        delay = self.backoff.failed(error)
+        logger.info('retrying in %.1f s (%s error #%d)', delay, error, self.backoff.failures)
+        self._wait(delay)
+
+    def getSession(self):
+        """Get the state needed to continue this session in a new process."""
+        return {
+            'address': self.address,
+            'token': self.params['token'],
+            'registered': self.registered,
+            'protocol': self.protocol,
+            'prefix': self.prefix,
+        }
+
+    def setSession(self, session):
+        """Continue a session, see getSession()."""
+        self.params['token'] = session['token']
+        self.registered = bool(session['registered'])
+        self._remember_route(session['protocol'], session['prefix'])
+
+    def _store_code(self, filename, lines):
+        """Write the program from an iterable of (bytes) lines.
+
+        The program is written to a temp file and renamed, so that a failed
+        download does not leave a partial program behind. Returns the sha256
+        of the downloaded lines.
+        """
         # TODO: what can we do if the file can't be overwritten
         # https://github.com/OpenRoberta/robertalab-ev3dev/issues/26
         # - there is no point in catching if we only log it
         # - once we can report error details to the server, we can reconsider
         #   https://github.com/OpenRoberta/robertalab-ev3dev/issues/20
-        with open(filename, 'w') as prog:
-            # Apply hotfixes needed until server update
-            # - the server generated code is python2 still
-            code = code.replace('from __future__ import absolute_import\n', '')
-            code = code.replace('in xrange(', 'in range(')
-            code = code.replace('#!/usr/bin/python\n', '#!/usr/bin/python3\n')
-            prog.write(code)
-        os.chmod(filename, stat.S_IXUSR | stat.S_IRUSR | stat.S_IWUSR)
-        return code
+        digest = hashlib.sha256()
+        code_digest = hashlib.sha256()
+        size = 0
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as prog:
+                for line in lines:
+                    digest.update(line)
+                    # Apply hotfixes needed until server update
+                    # - the server generated code is python2 still
+                    line = line.replace(b'from __future__ import absolute_import\n', b'')
+                    line = line.replace(b'in xrange(', b'in range(')
+                    line = line.replace(b'#!/usr/bin/python\n', b'#!/usr/bin/python3\n')
+                    code_digest.update(line)
+                    size += len(line)
+                    prog.write(line)
+            # don't replace the file if the same program is run again
+            if self._file_digest(filename, size) == code_digest.digest():
+                logger.debug('code unchanged: %s', filename)
+                os.remove(tmp_filename)
+            else:
+                os.chmod(tmp_filename, stat.S_IXUSR | stat.S_IRUSR | stat.S_IWUSR)
+                os.replace(tmp_filename, filename)
+        except:  # noqa: E722
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        return digest.hexdigest()
+
+    def _file_digest(self, filename, size):
+        # sha256 of the file, or None if it does not exist or has a different size
+        try:
+            with open(filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size != size:
+                    return None
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(io.DEFAULT_BUFFER_SIZE), b''):
+                    digest.update(chunk)
+                return digest.digest()
+        except OSError:
+            return None
+
+    def _compile_code(self, filename, code):
+        # compiled programs are cached by a hash of the file name and source
+        # (the file name is part of the code objects), errors when accessing
+        # the cache are not fatal, we just compile the code again
+        digest = hashlib.sha256()
+        for part in (sys.implementation.cache_tag, filename, code):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        path = os.path.join(self.code_cache, digest.hexdigest() + '.pyc')
+        start = time.time()
+        try:
+            with open(path, 'rb') as cached:
+                data = cached.read()
+            (compile_time,) = self.CODE_CACHE_HEADER.unpack_from(data)
+            compiled_code = marshal.loads(data[self.CODE_CACHE_HEADER.size:])
+            # keep recently used entries, see below
+            os.utime(path)
+            logger.info('code loaded from cache, saved %.1f ms',
+                        (compile_time - (time.time() - start)) * 1000)
+            return compiled_code
+        except (OSError, EOFError, ValueError, TypeError, struct.error):
+            pass
+
+        compiled_code = compile(code, filename, 'exec')
+        compile_time = time.time() - start
+        try:
+            os.makedirs(self.code_cache, exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as cached:
+                cached.write(self.CODE_CACHE_HEADER.pack(compile_time))
+                cached.write(marshal.dumps(compiled_code))
+            os.replace(tmp_path, path)
+            # drop the oldest entries
+            entries = [os.path.join(self.code_cache, name) for name in os.listdir(self.code_cache)
+                       if name.endswith('.pyc')]
+            entries.sort(key=os.path.getmtime)
+            for entry in entries[:-self.CODE_CACHE_SIZE]:
+                os.remove(entry)
+        except OSError as e:
+            logger.warning('failed to cache code: %s', e)
+        return compiled_code
 
     def _exec_code(self, filename, code, abort_handler):
         result = 0
@@ -285,15 +1067,27 @@ class Connector(threading.Thread):
         # NOTE: we don't have to keep pinging the server while running
         #   the code - robot is busy until we send push request again
         #   it would be nice though if we could cancel the running program
+        profiler = HalProfiler() if self.profiling else None
+        profile = None
         try:
-            compiled_code = compile(code, filename, 'exec')
+            compiled_code = self._compile_code(filename, code)
             with abort_handler:
-                scope = {
-                    '__name__': '__main__',
-                    'result': 0,
-                }
-                exec(compiled_code, scope)
-                result = scope['result']
+                if EXEC_IN_SUBPROCESS:
+                    (result, profile) = self._exec_in_subprocess(compiled_code)
+                else:
+                    scope = {
+                        '__name__': '__main__',
+                        'result': 0,
+                    }
+                    if profiler:
+                        profiler.start()
+                    try:
+                        exec(compiled_code, scope)
+                    finally:
+                        if profiler:
+                            profiler.stop()
+                            profile = profiler.report()
+                    result = scope['result']
             logger.info('execution finished: result = %d', result)
         except KeyboardInterrupt:
             logger.info("reraise hard kill")
@@ -306,39 +1100,146 @@ class Connector(threading.Thread):
             # TODO: return exception details as a string and put into a
             # 'nepoexitdetails' field, so that we can show this in the UI
             logger.exception("Ooops:")
+        finally:
+            if profile:
+                self._write_profile(filename, result, profile)
         return result
 
+    def _write_profile(self, filename, result, profile):
+        profile['result'] = result
+        profile_filename = os.path.splitext(filename)[0] + '.profile.json'
+        try:
+            with open(profile_filename, 'w') as f:
+                json.dump(profile, f, separators=(',', ':'))
+            logger.info('profile written to: %s', profile_filename)
+        except OSError as e:
+            logger.warning('failed to write profile: %s', e)
+
+    def _exec_in_subprocess(self, compiled_code):
+        # returns (result, profile report)
+        ctx = startZygote()
+        (result_r, result_w) = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=runProgram,
+                              args=(marshal.dumps(compiled_code), result_w, self.profiling))
+        process.daemon = True
+        process.start()
+        result_w.close()
+        try:
+            while process.is_alive():
+                process.join(self.EXEC_WAIT_TIMEOUT)
+        except BaseException:
+            # an abort, stop the program as well (Process.kill() needs python 3.7)
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+            raise
+        finally:
+            try:
+                (result, profile) = result_r.recv() if result_r.poll() else (None, None)
+            except EOFError:
+                (result, profile) = (None, None)
+            result_r.close()
+        if process.exitcode == 0 and result is not None:
+            return (result, profile)
+        if process.exitcode < 0:
+            logger.info('program killed by signal %d', -process.exitcode)
+            return (143, profile)
+        logger.info('program failed: exit code %d', process.exitcode)
+        return (1, profile)
+
     def _request(self, cmd, headers, timeout, send_params=True):
-        protocol = 'https'
-        url = '%s://%s/%s' % (protocol, self.address, cmd)
+        # start with the scheme and path that worked last time
+        protocol = self.protocol
+        prefix = self.prefix
         while True:
+            url = '%s://%s/%s%s' % (protocol, self.address, prefix, cmd)
             try:
                 logger.debug('sending request to: %s', url)
-                req = urllib.request.Request(url, headers=headers)
                 data = None
                 if send_params:
-                    data = json.dumps(self.params).encode('utf8')
+                    params = self.params
+                    if COMPACT_PUSH and cmd == 'pushcmd' and params.get('cmd') == 'push':
+                        params = dict((k, params[k]) for k in Connector.PUSH_PARAMS if k in params)
+                    data = json.dumps(params).encode('utf8')
                     logger.debug('  with params: %s', data)
-                return urllib.request.urlopen(req, data, timeout=timeout)
+                response = self.session.request(url, data, headers, timeout)
+                break
             except urllib.error.HTTPError as e:
-                if e.code == 404 and '/rest/' not in url:
+                if e.code == 404 and not prefix:
                     logger.warning("HTTPError(%s): %s, retrying with '/rest'", e.code, e.reason)
                     # upstream changed the server path
-                    url = '%s://%s/rest/%s' % (protocol, self.address, cmd)
+                    prefix = 'rest/'
+                elif e.code == 304:
+                    # not modified, see _download()
+                    self._remember_route(protocol, prefix)
+                    raise e
                 elif e.code == 405 and protocol == 'https':
                     # TODO(ensonic): this only works for http->https
                     logger.warning("HTTPError(%s): %s, retrying with 'http://'", e.code, e.reason)
                     protocol = 'http'
-                    url = "http" + url[5:]
                 else:
                     logger.warning("HTTPError(%s): %s, unhandled!'", e.code, e.reason)
+                    # the server did answer, so the route is fine
+                    self._remember_route(protocol, prefix)
                     raise e
             except urllib.error.URLError as e:
+                if protocol == 'http':
+                    self._forget_route()
+                    raise e
                 # [SSL: UNKNOWN_PROTOCOL] unknown protocol
                 logger.warning("URLError(%s): %s, retrying with 'http://'", e.errno, e.reason)
                 protocol = 'http'
-                url = "http" + url[5:]
-        return None
+            self.fallback_probes += 1
+        self._remember_route(protocol, prefix)
+        return response
+
+    def _download(self, headers, timeout):
+        """Download the program and store it, returns the filename."""
+        # send the hash of the last program, so that the server can reply with
+        # 'not modified' if the user runs the same program again, servers that
+        # don't support this just send the program
+        headers = dict(headers)
+        headers['Accept-Encoding'] = 'gzip'
+        if self.last_download and os.path.exists(self.last_download[1]):
+            headers['If-None-Match'] = self.last_download[0]
+        try:
+            response = self._request('download', headers, timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or 'If-None-Match' not in headers:
+                raise e
+            filename = self.last_download[1]
+            logger.info('code not modified: %s', filename)
+            return filename
+        hdr = response.getheader('Content-Disposition')
+        # save to $HOME/
+        filename = os.path.join(self.home, hdr.split('=')[1] if hdr else 'unknown')
+        etag = response.getheader('ETag')
+        digest = self._store_code(filename, self._decoded(response))
+        self.last_download = (etag or '"%s"' % digest, filename)
+        return filename
+
+    def _decoded(self, response):
+        # the body of a response, we ask for gzip for the downloads
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            # import it here, since we don't use it otherwise
+            import gzip
+            return gzip.GzipFile(fileobj=response, mode='rb')
+        return response
+
+    def _remember_route(self, protocol, prefix):
+        if (protocol, prefix) != (self.protocol, self.prefix):
+            logger.info('using %s://%s/%s (after %d fallback probes)', protocol, self.address, prefix,
+                        self.fallback_probes)
+        self.protocol = protocol
+        self.prefix = prefix
+        self.route_failures = 0
+
+    def _forget_route(self):
+        self.route_failures += 1
+        if self.route_failures >= Connector.MAX_ROUTE_FAILURES and (self.protocol, self.prefix) != ('https', ''):
+            logger.info('%d failed requests, probing the server again', self.route_failures)
+            self.protocol = 'https'
+            self.prefix = ''
+            self.route_failures = 0
 
     def run(self):
         logger.debug('network thread started')
@@ -349,42 +1250,45 @@ class Connector(threading.Thread):
         headers = {
             'Content-Type': 'application/json'
         }
-        timeout = 15  # seconds
 
         logger.debug('target: %s', self.address)
         while self.running:
             if self.registered:
                 self.params['cmd'] = 'push'
-                timeout = 15
+                timeout = Connector.PUSH_TIMEOUT
             else:
                 self.params['cmd'] = 'register'
-                timeout = 330
-            self.params['brickname'] = socket.gethostname()
-            self.params['battery'] = getBatteryVoltage()
+                timeout = Connector.REGISTER_TIMEOUT
+            self._update_status()
 
             try:
-                # TODO: according to https://tools.ietf.org/html/rfc6202
-                # we should use keep alive
-                # http://stackoverflow.com/questions/1037406/python-urllib2-with-keep-alive
-                # http://stackoverflow.com/questions/13881196/remove-http-connection-header-python-urllib2
-                # https://github.com/jcgregorio/httplib2
+                # we keep the connection alive between requests, see
+                # https://tools.ietf.org/html/rfc6202
                 response = self._request("pushcmd", headers, timeout)
                 reply = json.loads(response.read().decode('utf8'))
                 logger.debug('response: %s', json.dumps(reply))
                 cmd = reply['cmd']
+                # an update only succeeds once it has been installed
+                if cmd not in ('abort', 'update'):
+                    self.backoff.succeeded()
                 if cmd == 'repeat':
                     if not self.registered:
                         self.service.status('registered')
                         self.service.hal.playFile(2)
+                        self.service.hal.releaseSound()
+                        if EXEC_IN_SUBPROCESS:
+                            # have the imports done before the first program is started
+                            startZygote()
                     self.registered = True
                     self.params['nepoexitvalue'] = 0
+                    self._wait(self.push_interval)
                 elif cmd == 'abort':
                     # if service is None, the user canceled
                     if not self.registered and self.service:
                         logger.info('token collision, retrying')
                         self.params['token'] = generateToken()
                         # make sure we don't DOS the server
-                        time.sleep(1.0)
+                        self._retry_later('collision')
                     else:
                         break
                 elif cmd == 'download':
@@ -392,12 +1296,10 @@ class Connector(threading.Thread):
                     # TODO: we should receive a digest for the download (md5sum) so that
                     #   we can verify the download
                     logger.debug('download code: %s/download', self.address)
-                    response = self._request('download', headers, timeout)
-                    hdr = response.getheader('Content-Disposition')
-                    # save to $HOME/
-                    filename = os.path.join(self.home, hdr.split('=')[1] if hdr else 'unknown')
-                    code = self._store_code(filename, response.read().decode('utf-8'))
+                    filename = self._download(headers, timeout)
                     logger.info('code downloaded to: %s', filename)
+                    with open(filename, 'r', encoding='utf-8') as prog:
+                        code = prog.read()
                     # use a long-press of backspace to terminate
                     abort_handler = AbortHandler(self.service, self)
                     abort_handler.daemon = True
@@ -413,24 +1315,24 @@ class Connector(threading.Thread):
                         self.service.hal.resetState()
                     self.service.status('registered')
                 elif cmd == 'update':
-                    # import them here, since we don't use them otherwise
-                    from io import BytesIO
-                    import shutil
-                    import zipfile
-
                     logger.info('download update: %s/update/ev3dev/runtime', self.address)
                     # fetch roberta.zip
-                    response = self._request('update/ev3dev/runtime', headers, timeout, send_params=False)
-                    zip_buf = BytesIO(response.read())
-                    # remove the 'roberta' dir first and then recreate to make sure we don't accumulate files
-                    shutil.rmtree(os.path.join(local_pkg_path, 'roberta'), ignore_errors=True)
-                    # and unpack update
-                    with zipfile.ZipFile(zip_buf, 'r') as zip_ref:
-                        zip_ref.extractall(local_pkg_path)
-                    logger.info('firmware updated')
-                    # then restart:
-                    # TODO: maybe we can reuse the token (pass as arg)?
-                    os.execl(sys.executable, sys.executable, *sys.argv)
+                    update_headers = dict(headers)
+                    update_headers['Accept-Encoding'] = 'gzip'
+                    response = self._request('update/ev3dev/runtime', update_headers, timeout, send_params=False)
+                    # the new package replaces the old one as a whole, so we don't accumulate files
+                    try:
+                        installUpdate(self._decoded(response), local_pkg_path, response.getheader('Digest'))
+                    except ValueError as e:
+                        logger.error('update failed: %s', e)
+                        # the server keeps sending 'update', don't download it again right away
+                        self._retry_later('update')
+                    else:
+                        logger.info('firmware updated')
+                        # then restart and continue with the same token
+                        os.environ[SESSION_ENV] = json.dumps(self.getSession())
+                        self.session.close()
+                        os.execl(sys.executable, sys.executable, *sys.argv)
                 else:
                     logger.warning('unhandled command: %s', cmd)
             except urllib.error.HTTPError as e:
@@ -446,6 +1348,7 @@ class Connector(threading.Thread):
                     break
                 else:
                     logger.error("HTTPError(%s): %s (retrying)", e.code, e.reason)
+                    self._retry_later('server')
             except urllib.error.URLError as e:
                 # e.g. [Errno 111] Connection refused
                 #                  The handshake operation timed out
@@ -478,13 +1381,18 @@ class Connector(threading.Thread):
                     break
                 else:
                     logger.info("URLError: %s: %s (retrying)", self.address, e.reason)
+                    self._retry_later('network')
             except (socket.timeout, socket.gaierror, socket.herror, socket.error):
-                pass
+                self._retry_later('network')
             except:  # noqa: E722
                 logger.exception("Ooops:")
-        logger.info('network thread stopped')
+                self._retry_later('other')
+        self.session.close()
+        logger.info('network thread stopped (%d connections made, %d fallback probes)',
+                    self.session.handshakes, self.fallback_probes)
         if self.service:
             self.service.status('disconnected')
             # don't play if we we just canceled a registration
             if self.registered:
                 self.service.hal.playFile(3)
+                self.service.hal.releaseSound()
@@ -1,5 +1,7 @@
 # Hal and Ev3dev class to satisfy testing
 
+import os
+
 from PIL import Image, ImageDraw
 
 
@@ -14,6 +16,9 @@ class Hal(object):
     def playFile(self, systemSound):
         pass
 
+    def releaseSound(self):
+        pass
+
 
 class Ev3dev(object):
     OUTPUT_A = 'outA'
@@ -34,20 +39,50 @@ class Ev3dev(object):
         LEFT = 4
         RIGHT = 5
 
+        @staticmethod
+        def all_off():
+            pass
+
     Sound = None
 
-    def Button():
-        return None
+    class Button(object):
+
+        def __init__(self):
+            self.pressed = []
+            self.reads = 0
+
+        @property
+        def buttons_pressed(self):
+            self.reads += 1
+            return self.pressed
 
     class PowerSupply(object):
         measured_volts = 0.0
 
     class Screen(object):
-        draw = None
+        """Emulates a 1 bit-per-pixel framebuffer like on the EV3."""
+
+        class FixInfo(object):
+            line_length = 24
+
+        class VarInfo(object):
+            bits_per_pixel = 1
 
         def __init__(self):
-            im = Image.new('1', (178, 128), (0))
-            self.draw = ImageDraw.Draw(im)
+            self.fix_info = Ev3dev.Screen.FixInfo()
+            self.var_info = Ev3dev.Screen.VarInfo()
+            self.mmap = bytearray(self.fix_info.line_length * 128)
+            self.image = Image.new('1', (self.fix_info.line_length * 8, 128), 'white')
+            self.draw = ImageDraw.Draw(self.image)
+            self.updates = 0
+
+        def clear(self):
+            self.draw.rectangle(((0, 0), self.image.size), fill='white')
+
+        def update(self):
+            self.updates += 1
+            b = self.image.tobytes('raw', '1;R')
+            self.mmap[:len(b)] = b
 
     class LargeMotor(object):
 
@@ -75,3 +110,47 @@ class Ev3dev(object):
 
         def stop(self):
             pass
+
+    class LegoPort(object):
+
+        def __init__(self, port):
+            self.port = port
+            self.mode = None
+
+    class Sensor(object):
+
+        def __init__(self, port=None, **kwargs):
+            self.port = port
+            self.decimals = 0
+            self.values = [0]
+            self.bin_data_format = 's32'
+            self.mode_reads = 0
+            self.value_reads = 0
+            self._mode = None
+            # set to a directory to read the values from files, like sysfs
+            self._path = None
+
+        @property
+        def mode(self):
+            self.mode_reads += 1
+            return self._mode
+
+        @mode.setter
+        def mode(self, mode):
+            self._mode = mode
+
+        @property
+        def num_values(self):
+            return len(self.values)
+
+        def value(self, n=0):
+            self.value_reads += 1
+            if self._path:
+                with open(os.path.join(self._path, 'value%d' % n)) as f:
+                    return int(f.read())
+            return self.values[n]
+
+    ColorSensor = Sensor
+    GyroSensor = Sensor
+    InfraredSensor = Sensor
+    UltrasonicSensor = Sensor
@@ -1,15 +1,68 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import _thread
+import threading
+import time
 import unittest
 
-from .ev3 import Hal
+from PIL import Image, ImageDraw
+
+from .ev3 import Hal, SoundCache
 from .test import Ev3dev as ev3dev
 
 
+class TestSoundCache(unittest.TestCase):
+    def test_renderTones(self):
+        pcm = SoundCache.renderTones([(440, 100, 50), (0, 10, 0)])
+        self.assertEqual(len(pcm), 2 * (int(SoundCache.RATE * 0.1) + int(SoundCache.RATE * 0.05) +
+                                        int(SoundCache.RATE * 0.01)))
+
+    def test_get_RendersOnce(self):
+        cache = SoundCache()
+        calls = []
+
+        def render(arg):
+            calls.append(arg)
+            return bytes(10)
+
+        cache.get('a', render, 1)
+        cache.get('a', render, 1)
+        self.assertEqual(calls, [1])
+
+    def test_get_EvictsOldest(self):
+        cache = SoundCache(max_size=25)
+        for key in ['a', 'b', 'a', 'c']:
+            cache.get(key, bytes, 10)
+        self.assertEqual(list(cache.sounds), ['a', 'c'])
+        self.assertEqual(cache.size, 20)
+
+    def test_play(self):
+        cache = SoundCache()
+        cache.PLAYER = ['sh', '-c', 'cat >/dev/null']
+        end = cache.play(SoundCache.renderTones([(440, 100, 0)]))
+        self.assertAlmostEqual(end - time.time(), 0.1, delta=0.05)
+        player = cache.player
+        cache.play(SoundCache.renderTones([(440, 100, 0)]))
+        self.assertIs(cache.player, player)
+        cache.stop()
+        self.assertIsNone(cache.player)
+
+
 class TestHal(unittest.TestCase):
     def test__init__no_cfg(self):
         hal = Hal(None)
         self.assertNotEqual(0, hal.font_w)
         self.assertNotEqual(0, hal.font_h)
 
+    def test__init__OpensScreenOnFirstUse(self):
+        hal = Hal(None)
+        self.assertIsNone(hal._lcd)
+        hal.clearDisplay()
+        self.assertIsNotNone(hal._lcd)
+
     def test__init__simple_cfg(self):
         brickConfiguration = {
             'wheel-diameter': 5.6,
@@ -35,6 +88,19 @@ class TestHal(unittest.TestCase):
         hal = Hal(brickConfiguration)
         self.assertIsNotNone(hal.cfg['actors']['B'])
 
+    def _getSensorHal(self):
+        brickConfiguration = {
+            'wheel-diameter': 5.6,
+            'track-width': 18.0,
+            'actors': {
+            },
+            'sensors': {
+                '1': Hal.makeColorSensor(ev3dev.INPUT_1),
+                '2': Hal.makeGyroSensor(ev3dev.INPUT_2),
+            },
+        }
+        return Hal(brickConfiguration)
+
     def _getStdHal(self):
         brickConfiguration = {
             'wheel-diameter': 5.6,
@@ -48,6 +114,346 @@ class TestHal(unittest.TestCase):
         }
         return Hal(brickConfiguration)
 
+    # display
+    def _framebuffer(self, hal):
+        return bytes(hal.lcd.image.tobytes('raw', '1;R'))
+
+    def test_drawText_UpdatesRows(self):
+        hal = Hal(None)
+        hal.clearDisplay()
+        fb = bytes(hal.lcd.mmap)
+        hal.drawText('42', 0, 2)
+        ll = hal.lcd.fix_info.line_length
+        (first, last) = (2 * hal.font_h * ll, 3 * hal.font_h * ll)
+        self.assertEqual(hal.lcd.mmap, self._framebuffer(hal))
+        self.assertNotEqual(hal.lcd.mmap[first:last], fb[first:last])
+        self.assertEqual(hal.lcd.mmap[:first], fb[:first])
+        self.assertEqual(hal.lcd.mmap[last:], fb[last:])
+        self.assertEqual(hal.lcd.updates, 0)
+
+    def test_drawText_Frame(self):
+        hal = Hal(None)
+        hal.clearDisplay()
+        fb = bytes(hal.lcd.mmap)
+        hal.beginFrame()
+        for i in range(4):
+            hal.drawText('value %d: %d' % (i, i * 10), 0, i * 2)
+        self.assertEqual(hal.lcd.mmap, fb)
+        hal.commitFrame()
+        self.assertEqual(hal.lcd.mmap, self._framebuffer(hal))
+
+    def test_drawText_NestedFrames(self):
+        hal = Hal(None)
+        hal.clearDisplay()
+        fb = bytes(hal.lcd.mmap)
+        hal.beginFrame()
+        hal.beginFrame()
+        hal.drawText('a', 0, 0)
+        hal.commitFrame()
+        self.assertEqual(hal.lcd.mmap, fb)
+        hal.commitFrame()
+        self.assertEqual(hal.lcd.mmap, self._framebuffer(hal))
+
+    def test_drawText_CachedTextMatchesFont(self):
+        for size in Hal.FONTS:
+            hal = Hal(None)
+            hal.clearDisplay()
+            text = 'Wert: -12.5 %d' % size
+            hal.drawText(text, 1, 1, font=size)
+            expected = Image.new('1', hal.lcd.image.size, 'white')
+            ImageDraw.Draw(expected).text((hal.font_w, hal.font_h), text, font=Hal.getFont(size))
+            self.assertEqual(hal.lcd.image.tobytes(), expected.tobytes())
+
+    def test_getFont_Lazy(self):
+        Hal.fonts.pop(18, None)
+        hal = Hal(None)
+        self.assertNotIn(18, Hal.fonts)
+        hal.drawText('big', 0, 0, font=18)
+        self.assertIn(18, Hal.fonts)
+
+    # waitCmd
+    def test_waitCmd(self):
+        hal = Hal(None)
+        cmd = subprocess.Popen(['sleep', '0.3'])
+        (wall, cpu) = (time.time(), time.process_time())
+        hal.waitCmd(cmd)
+        (wall, cpu) = (time.time() - wall, time.process_time() - cpu)
+        self.assertEqual(cmd.returncode, 0)
+        self.assertNotIn(cmd, Hal.cmds)
+        self.assertLess(cpu, wall / 2)
+
+    def test_readCmd(self):
+        hal = Hal(None)
+        cmd = subprocess.Popen(['sh', '-c', 'sleep 0.2; echo hello'], stdout=subprocess.PIPE)
+        self.assertEqual(hal.readCmd(cmd), b'hello\n')
+        self.assertNotIn(cmd, Hal.cmds)
+        cmd = subprocess.Popen(['sh', '-c', 'exit 3'], stdout=subprocess.PIPE)
+        with self.assertRaises(subprocess.CalledProcessError):
+            hal.readCmd(cmd)
+
+    def test_readCmd_Interruptible(self):
+        hal = Hal(None)
+        cmd = subprocess.Popen(['sleep', '10'], stdout=subprocess.PIPE)
+        timer = threading.Timer(0.2, _thread.interrupt_main)
+        timer.start()
+        start = time.time()
+        with self.assertRaises(KeyboardInterrupt):
+            hal.readCmd(cmd)
+        self.assertLess(time.time() - start, 2)
+        # left for resetState() to terminate
+        self.assertIn(cmd, Hal.cmds)
+        Hal.cmds.remove(cmd)
+        cmd.kill()
+        cmd.communicate()
+
+    def _useSoundCache(self, player):
+        self.addCleanup(setattr, Hal, 'sound_cache', Hal.sound_cache)
+        self.addCleanup(setattr, Hal, 'USE_SOUND_CACHE', Hal.USE_SOUND_CACHE)
+        Hal.sound_cache = SoundCache()
+        Hal.sound_cache.PLAYER = player
+        Hal.USE_SOUND_CACHE = True
+
+    def test_playCached_RenderFailure(self):
+        hal = Hal(None)
+        self._useSoundCache(['sh', '-c', 'cat >/dev/null'])
+
+        def render(text):
+            raise subprocess.CalledProcessError(1, 'espeak')
+
+        self.assertFalse(hal.playCached(('speech', 'hello'), render, 'hello'))
+        self.assertTrue(Hal.USE_SOUND_CACHE)
+        self.assertTrue(hal.playCached(('tones', 440), bytes, 10))
+        self.assertIsNotNone(Hal.sound_cache.player)
+        # the player is released for the fallback
+        self.assertFalse(hal.playCached(('speech', 'hello'), render, 'hello'))
+        self.assertIsNone(Hal.sound_cache.player)
+
+    def test_resetState_ReleasesPlayer(self):
+        hal = Hal(None)
+        self._useSoundCache(['sh', '-c', 'cat >/dev/null'])
+        self.assertTrue(hal.playCached(('tones', 440), bytes, 10))
+        player = Hal.sound_cache.player
+        self.assertIsNone(player.poll())
+        hal.resetState()
+        self.assertIsNone(Hal.sound_cache.player)
+        self.assertIsNotNone(player.poll())
+
+    def test_playCached_PlayerFailure(self):
+        hal = Hal(None)
+        self._useSoundCache(['/nonexistent/aplay'])
+        self.assertFalse(hal.playCached(('tones', 440), bytes, 10))
+        self.assertFalse(Hal.USE_SOUND_CACHE)
+
+    # isKeyPressed
+    def test_isKeyPressed(self):
+        hal = Hal(None)
+        hal.keys.pressed = ['enter', 'down']
+        self.assertTrue(hal.isKeyPressed('enter'))
+        self.assertTrue(hal.isKeyPressed('down'))
+        self.assertTrue(hal.isKeyPressed('any'))
+        self.assertFalse(hal.isKeyPressed('back'))
+        self.assertEqual(hal.keys.reads, 1)
+
+    def test_isKeyPressed_Alias(self):
+        hal = Hal(None)
+        hal.keys.pressed = ['backspace']
+        self.assertTrue(hal.isKeyPressed('back'))
+        self.assertTrue(hal.isKeyPressed('escape'))
+
+    def test_isKeyPressed_NoMaxAge(self):
+        hal = Hal(None)
+        hal.keys_max_age = 0.0
+        self.assertFalse(hal.isKeyPressed('any'))
+        hal.keys.pressed = ['up']
+        self.assertTrue(hal.isKeyPressed('any'))
+        self.assertEqual(hal.keys.reads, 2)
+
+    # getSensor
+    def test_getSensor_ReadsModeOnce(self):
+        hal = self._getSensorHal()
+        s = hal.cfg['sensors']['1']
+        s.values = [2]
+        self.assertEqual(hal.getColorSensorColour('1'), 'blue')
+        self.assertEqual(hal.getColorSensorColour('1'), 'blue')
+        self.assertEqual(s.mode_reads, 1)
+        self.assertEqual(s.mode, 'COL-COLOR')
+
+    def test_getSensor_ModeChange(self):
+        hal = self._getSensorHal()
+        s = hal.cfg['sensors']['1']
+        hal.getColorSensorColour('1')
+        hal.getColorSensorRed('1')
+        self.assertEqual(s.mode, 'COL-REFLECT')
+
+    def test_getSensor_ResetGyro(self):
+        hal = self._getSensorHal()
+        s = hal.cfg['sensors']['2']
+        hal.getGyroSensorValue('2', 'rate')
+        hal.resetGyroSensor('2')
+        hal.getGyroSensorValue('2', 'angle')
+        self.assertEqual(s.mode_reads, 1)
+        self.assertEqual(s.mode, 'GYRO-ANG')
+
+    def test_resetSensorModes(self):
+        hal = self._getSensorHal()
+        s = hal.cfg['sensors']['1']
+        hal.getColorSensorColour('1')
+        s.mode = 'COL-AMBIENT'
+        hal.resetSensorModes('1')
+        hal.getColorSensorColour('1')
+        self.assertEqual(s.mode, 'COL-COLOR')
+
+    # scaledValues
+    def _makeSysfsSensor(self, s, fmt, values):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        s._path = path
+        s.values = values
+        s.bin_data_format = fmt
+        with open(os.path.join(path, 'bin_data'), 'wb') as f:
+            fmt = Hal.BIN_DATA_FORMATS[fmt]
+            f.write(struct.pack(fmt[0] + fmt[1] * len(values), *values))
+        for (i, v) in enumerate(values):
+            with open(os.path.join(path, 'value%d' % i), 'w') as f:
+                f.write('%d\n' % v)
+
+    def test_scaledValues_BinData(self):
+        hal = self._getSensorHal()
+        s = hal.cfg['sensors']['1']
+        self._makeSysfsSensor(s, 's16', [-3, 120, 512])
+        self.assertEqual(hal.getColorSensorRgb('1'), (-3.0, 120.0, 512.0))
+        self.assertEqual(s.value_reads, 0)
+        self.assertEqual(hal.scaledValues(s), (-3.0, 120.0, 512.0))
+
+    def test_scaledValues_BinDataDecimals(self):
+        hal = self._getSensorHal()
+        s = hal.cfg['sensors']['1']
+        self._makeSysfsSensor(s, 'u8', [10, 25, 255])
+        s.decimals = 1
+        self.assertEqual(hal.getColorSensorRgb('1'), (1.0, 2.5, 25.5))
+        self.assertEqual(s.value_reads, 0)
+
+    def test_readAttributeInto(self):
+        hal = self._getSensorHal()
+        s = hal.cfg['sensors']['1']
+        self._makeSysfsSensor(s, 'u8', [1, 2, 3])
+        buf = bytearray(3)
+        self.assertEqual(hal.readAttributeInto(s, 'bin_data', buf), 3)
+        self.assertEqual(buf, bytearray([1, 2, 3]))
+        with open(os.path.join(s._path, 'bin_data'), 'wb') as f:
+            f.write(bytes([4, 5, 6]))
+        self.assertEqual(hal.readAttributeInto(s, 'bin_data', buf), 3)
+        self.assertEqual(buf, bytearray([4, 5, 6]))
+        if hasattr(os, 'preadv'):
+            # python < 3.7
+            self.addCleanup(setattr, os, 'preadv', os.preadv)
+            del os.preadv
+            with open(os.path.join(s._path, 'bin_data'), 'wb') as f:
+                f.write(bytes([7, 8, 9]))
+            self.assertEqual(hal.readAttributeInto(s, 'bin_data', buf), 3)
+            self.assertEqual(buf, bytearray([7, 8, 9]))
+        hal.cache_attributes = False
+        with open(os.path.join(s._path, 'bin_data'), 'wb') as f:
+            f.write(bytes([10, 11, 12]))
+        self.assertEqual(hal.readAttributeInto(s, 'bin_data', buf), 3)
+        self.assertEqual(buf, bytearray([10, 11, 12]))
+
+    def test_scaledValues_NoBinData(self):
+        hal = self._getSensorHal()
+        s = hal.cfg['sensors']['1']
+        s.values = [1, 2, 3]
+        self.assertEqual(hal.getColorSensorRgb('1'), (1.0, 2.0, 3.0))
+        self.assertEqual(s.value_reads, 3)
+
+    # readAttribute
+    def _makeSysfsMotor(self, m, state, position):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        m._path = path
+        self._writeSysfsMotor(m, state, position)
+
+    def _writeSysfsMotor(self, m, state, position):
+        with open(os.path.join(m._path, 'state'), 'w') as f:
+            f.write(state + '\n')
+        with open(os.path.join(m._path, 'position'), 'w') as f:
+            f.write('%d\n' % position)
+
+    def test_getMotorState_Cached(self):
+        hal = self._getStdHal()
+        m = hal.cfg['actors']['B']
+        self._makeSysfsMotor(m, 'running ramping', 10)
+        self.assertEqual(hal.getMotorState(m), ['running', 'ramping'])
+        self.assertEqual(hal.getMotorPosition(m), 10)
+        self._writeSysfsMotor(m, '', 20)
+        self.assertEqual(hal.getMotorState(m), [])
+        self.assertEqual(hal.getMotorPosition(m), 20)
+        self.assertEqual(len(hal.attribute_files), 2)
+
+    def test_getMotorState_Uncached(self):
+        hal = self._getStdHal()
+        hal.cache_attributes = False
+        m = hal.cfg['actors']['B']
+        self._makeSysfsMotor(m, 'running', 10)
+        m.state = ['holding']
+        self.assertEqual(hal.getMotorState(m), ['holding'])
+        self.assertEqual(len(hal.attribute_files), 0)
+
+    def test_writeAttribute(self):
+        hal = Hal(None)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        command = os.path.join(path, 'command')
+        hal.writeAttribute(command, 'run-forever')
+        hal.writeAttribute(command, 'stop')
+        with open(command) as f:
+            self.assertTrue(f.read().startswith('stop'))
+        self.assertEqual(len(hal.attribute_files), 0)
+
+    def test_readAttribute_ClosesFileOnError(self):
+        hal = self._getStdHal()
+        m = hal.cfg['actors']['B']
+        self._makeSysfsMotor(m, 'running', 10)
+        hal.getMotorState(m)
+        key = (m._path, 'state')
+        hal.attribute_files[key].close()
+        # reading a write-only file fails, like reading an unplugged device
+        f = open(os.path.join(m._path, 'state'), 'ab', buffering=0)
+        hal.attribute_files[key] = f
+        self.assertIsNone(hal.readAttribute(m, 'state'))
+        self.assertTrue(f.closed)
+        self.assertNotIn(key, hal.attribute_files)
+
+    def test_closeAttributes(self):
+        hal = self._getStdHal()
+        m = hal.cfg['actors']['B']
+        self._makeSysfsMotor(m, 'running', 10)
+        hal.getMotorState(m)
+        files = list(hal.attribute_files.values())
+        self.assertEqual(len(files), 1)
+        hal.closeAttributes()
+        self.assertEqual(hal.attribute_files, {})
+        self.assertTrue(files[0].closed)
+
+    # waitForMotors
+    def test_waitForMotors_Sleeps(self):
+        hal = self._getStdHal()
+        m = hal.cfg['actors']['B']
+        self._makeSysfsMotor(m, 'running', 0)
+        timer = threading.Timer(0.3, self._writeSysfsMotor, args=(m, '', 90))
+        timer.start()
+        (wall, cpu) = (time.time(), time.process_time())
+        hal.rotateRegulatedMotor('B', 100, 'degree', 90.0)
+        (wall, cpu) = (time.time() - wall, time.process_time() - cpu)
+        timer.join()
+        self.assertGreaterEqual(wall, 0.3)
+        self.assertLess(cpu, wall / 2)
+
+    def test_waitForMotors_Stalled(self):
+        hal = self._getStdHal()
+        m = hal.cfg['actors']['B']
+        self._makeSysfsMotor(m, 'running stalled', 0)
+        hal.rotateRegulatedMotor('B', 100, 'degree', 90.0)
+
     # rotateRegulatedMotor
     def test_rotateRegulatedMotor_Degree(self):
         hal = self._getStdHal()